@@ -16,15 +16,47 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import io
+import os
 import re
 import sys
 import csv
+import math
+import json
 import codecs
+import hashlib
+import argparse
+import operator
+import functools
+import contextlib
 import collections
+import multiprocessing
 import termcolor
+import numpy as np
+
+import bootstrap
+from profiling import Profiler
+from survey_table import Table, TableBuilder, Histogram, AnswerIndex
 
 METADATA_LINES = 3
 
+# read_chunks and the --stream mode read this many responses at once.
+
+CHUNK_SIZE = 10000
+
+# load_data saves parsed exports next to them, in a file with this suffix.
+
+SNAPSHOT_SUFFIX = ".table"
+
+# Iterating over a demographic decodes this many responses at once.
+
+DECODE_CHUNK = 1024
+
+# --incremental checks that the part of the export it read before did not
+# change by hashing this many bytes at its beginning and end.
+
+CHECK_BYTES = 1 << 16
+
 # Questions that have multiple choices save the answer as a comma-separated
 # list of numbers, e.g.: 1,4,5,9
 
@@ -56,53 +88,190 @@ Response = collections.namedtuple("Response", ["start_date", "end_date",
 class Demographic(object):
     """
     Represents a demographic, i.e., a subset of all responses.
+
+    The responses are stored column by column in a Table, which all
+    demographics derived from it share.  A demographic only consists of the
+    (sorted) row numbers of its responses.
+
+    Once a demographic is indexed, the demographics derived from it are sets
+    over its AnswerIndex.  Filtering them, and combining them using &, |, -,
+    and ~, are then bitwise operations.
+
+    The answer counts of every question are computed in one pass over the
+    demographic when first needed, and cached for frac, pct, and count.
     """
 
-    def __init__(self, responses):
+    def __init__(self, responses, rows=None, index=None, bits=None):
+
+        if not isinstance(responses, Table):
+            responses = Table.from_rows(Response, responses)
+        self.table = responses
+        self.index = index
+        self.bits = bits
+        if rows is None and bits is None:
+            rows = np.arange(len(responses))
+        self._rows = rows
+        self.histograms = {}
+
+    @property
+    def rows(self):
+
+        if self._rows is None:
+            self._rows = self.index.rows[self.index.positions(self.bits)]
+
+        return self._rows
+
+    @property
+    def responses(self):
 
-        self.responses = responses
+        return list(self)
+
+    def indexed(self):
+        """Return this demographic with an AnswerIndex over its responses."""
+
+        index = AnswerIndex(self.table, self.rows)
+
+        return Demographic(self.table, self.rows, index, index.all)
+
+    def derive(self, bits):
+        """Return the demographic of the given set over our index."""
+
+        return Demographic(self.table, index=self.index, bits=bits)
 
     def __iter__(self):
 
-        for x in self.responses:
-            yield x
+        # Like a list's iterator, look up the next position on every step, but
+        # decode the following rows in bulk.
+
+        i = 0
+        decoded = {}
+        while i < len(self.rows):
+            row = int(self.rows[i])
+            if row not in decoded:
+                chunk = self.rows[i:i + DECODE_CHUNK]
+                decoded = dict(zip(chunk.tolist(),
+                                   self.table.responses(chunk)))
+            yield decoded[row]
+            i += 1
 
     def __len__(self):
 
-        return len(self.responses)
+        if self.index is not None:
+            return self.bits.bit_count()
+
+        return len(self.rows)
+
+    def combine(self, other, bitwise, rowwise):
+
+        if self.table is not other.table:
+            raise ValueError("Cannot combine demographics of different "
+                             "surveys.")
+        if self.index is not None and self.index is other.index:
+            return self.derive(bitwise(self.bits, other.bits))
+
+        return Demographic(self.table, rowwise(self.rows, other.rows))
+
+    def __and__(self, other):
+
+        return self.combine(other, operator.and_, np.intersect1d)
+
+    def __or__(self, other):
+
+        return self.combine(other, operator.or_, np.union1d)
+
+    def __sub__(self, other):
+
+        return self.combine(other, lambda x, y: x & ~y, np.setdiff1d)
+
+    def __invert__(self):
+
+        if self.index is not None:
+            return self.derive(self.index.all & ~self.bits)
+
+        return Demographic(self.table, np.setdiff1d(np.arange(len(self.table)),
+                                                    self.rows))
 
     def remove(self, elem):
 
-        self.responses.remove(elem)
+        # Narrow down the positions of matching rows field by field.
+
+        positions = np.arange(len(self.rows))
+        for field, value in zip(self.table.record._fields, elem):
+            column = self.table.columns[field]
+            positions = positions[column.equals(value,
+                                                self.rows[positions])]
+        if not len(positions):
+            raise ValueError("Demographic.remove(x): x not in demographic")
+
+        self.histograms = {}
+        row = self.rows[positions[0]]
+        self._rows = np.delete(self.rows, positions[0])
+        if self.index is not None:
+            self.bits &= ~(1 << int(np.searchsorted(self.index.rows, row)))
 
     def filter(self, question, answer):
         """Filter demographic for the given answer to the given question."""
 
         assert isinstance(question, str)
 
-        filtered = Demographic([])
-        for r in self.responses:
+        if self.index is not None:
+            return self.derive(self.bits &
+                               self.index.contains(question, answer))
+
+        column = self.table.columns[question]
+
+        return Demographic(self.table,
+                           self.rows[column.contains(answer, self.rows)])
+
+    def filter_any(self, question, answers):
+        """Filter demographic for any of the given answers to the given
+        question."""
 
-            if isinstance(r.__getattribute__(question), list):
-                match = lambda x, y: x in y
-            elif isinstance(r.__getattribute__(question), str):
-                match = lambda x, y: x == y
+        return functools.reduce(operator.or_, [self.filter(question, answer)
+                                               for answer in answers])
 
-            if match(answer, r.__getattribute__(question)):
-                filtered.responses.append(r)
+    def filter_subset(self, question, answers):
+        """
+        Filter demographic for responses whose answers to the given question
+        are all among the given answers.  Like set(answer).issubset(answers),
+        this includes responses that skipped the question.
+        """
 
-        return filtered
+        answers = set(answers)
+        column = self.table.columns[question]
+        others = [value for value in column.values
+                  if not set(value).issubset(answers)]
+
+        if self.index is not None:
+            return self.derive(functools.reduce(
+                lambda bits, value: bits & ~self.index.contains(question,
+                                                                value),
+                others, self.bits))
+
+        keep = np.ones(len(self.rows), dtype=bool)
+        for value in others:
+            keep &= ~column.contains(value, self.rows)
+
+        return Demographic(self.table, self.rows[keep])
+
+    def histogram(self, question):
+        """Return the Histogram of the answers to the given question."""
+
+        if question not in self.histograms:
+            self.histograms[question] = Histogram.of(
+                self.table.columns[question], self.rows)
+
+        return self.histograms[question]
 
     def frac(self, question, answer):
         """Return fraction that provided given answer to given question."""
 
-        # Get total number of responses, i.e., responses that didn't select an
-        # empty set of answers.
+        # The histogram's total is the number of responses that didn't select
+        # an empty set of answers.
 
-        total = len([r for r in self.responses
-                     if r.__getattribute__(question) != ""])
+        histogram = self.histogram(question)
 
-        return float(len(self.filter(question, answer))) / total
+        return float(histogram.contains(answer)) / histogram.total
 
     def pct(self, question, answer):
         """Return percentage that provided given answer to given question."""
@@ -111,8 +280,94 @@ class Demographic(object):
 
     def count(self, question, answer):
 
-        return len([r for r in self.responses
-                    if r.__getattribute__(question) == answer])
+        if isinstance(answer, str):
+            return self.histogram(question).equals(answer)
+
+        if self.index is not None:
+            return (self.bits & self.index.equals(question, answer)).bit_count()
+
+        column = self.table.columns[question]
+
+        return int(np.count_nonzero(column.equals(answer, self.rows)))
+
+
+class Summary(object):
+    """
+    The answer counts of a demographic that is read in chunks.
+
+    A summary offers the same frac, pct, and count as a Demographic, so that
+    the report functions work on both, but only holds one Histogram per
+    question.  We stop counting the answers to questions that have more than
+    MAX_VALUES distinct answers, e.g., free-text questions.
+    """
+
+    MAX_VALUES = 256
+
+    def __init__(self):
+
+        self.size = 0
+        self.histograms = {}
+        self.dropped = set()
+
+    def __len__(self):
+
+        return self.size
+
+    def add(self, demographic):
+        """Add the answer counts of the given demographic."""
+
+        self.size += len(demographic)
+        for question in demographic.table.columns:
+            if question in self.dropped:
+                continue
+            histogram = self.histograms.setdefault(question, Histogram())
+            histogram.update(demographic.histogram(question))
+            if len(histogram.contained) > self.MAX_VALUES:
+                self.dropped.add(question)
+                del self.histograms[question]
+
+    def to_dict(self):
+
+        return {"size": self.size,
+                "histograms": {q: [h.contained, h.equal, h.total]
+                               for q, h in self.histograms.items()},
+                "dropped": sorted(self.dropped)}
+
+    @classmethod
+    def from_dict(cls, d):
+
+        summary = cls()
+        summary.size = d["size"]
+        summary.histograms = {q: Histogram(*h)
+                              for q, h in d["histograms"].items()}
+        summary.dropped = set(d["dropped"])
+
+        return summary
+
+    def histogram(self, question):
+
+        if question in self.dropped:
+            raise KeyError("Question '%s' has more than %d distinct answers, "
+                           "which summaries don't count." %
+                           (question, self.MAX_VALUES))
+
+        return self.histograms.get(question, Histogram())
+
+    def frac(self, question, answer):
+        """Return fraction that provided given answer to given question."""
+
+        histogram = self.histogram(question)
+
+        return float(histogram.contains(answer)) / histogram.total
+
+    def pct(self, question, answer):
+        """Return percentage that provided given answer to given question."""
+
+        return self.frac(question, answer) * 100
+
+    def count(self, question, answer):
+
+        return self.histogram(question).equals(answer)
 
 
 def log(*args, **kwargs):
@@ -124,10 +379,11 @@ def log(*args, **kwargs):
           *args, file=sys.stderr, **kwargs)
 
 
-def parse_data(file_name):
-    """Parse survey data from the given file."""
-
-    responses = []
+def read_rows(file_name):
+    """
+    Yield the survey responses in the given file one by one, as lists whose
+    multiple-choice answers are lists, too.
+    """
 
     log("Attempting to open file '%s'." % file_name)
 
@@ -137,71 +393,420 @@ def parse_data(file_name):
         log(err)
         sys.exit(1)
 
-    csvread = csv.reader(fd, delimiter="\t")
-    for row in csvread:
+    # Discard the first three "responses" because they are meta data and not
+    # actual responses.
+
+    log("Discarding the first %d meta data lines." % METADATA_LINES)
 
-        # Turn non-text responses into lists.
+    with fd:
+        csvread = csv.reader(fd, delimiter="\t")
+        for line, row in enumerate(csvread):
+            if line < METADATA_LINES:
+                continue
+            yield classify(row)
 
-        for i, field in enumerate(row):
-            if re.match(MULTIPLE_CHOICE_RESPONSE, field.strip()):
-                row[i] = field.split(",")
 
-        responses.append(Response(*row))
+def classify(row):
+    """Turn the multiple-choice answers in the given row into lists."""
 
-    # Discard the first three "responses" because they are meta data and not
-    # actual responses.
+    # Turn non-text responses into lists.
 
-    log("Discarding the first %d meta data lines." % METADATA_LINES)
+    for i, field in enumerate(row):
+        if re.match(MULTIPLE_CHOICE_RESPONSE, field.strip()):
+            row[i] = field.split(",")
+
+    return row
+
+
+def read_appended(file_name, offset):
+    """
+    Yield the survey responses that follow the first `offset' bytes of the
+    given file, e.g., responses that were appended since we last read it.
+    """
+
+    with open(file_name, "rb") as fd:
+        bom = fd.read(2)
+        fd.seek(offset)
+        data = fd.read()
+
+    # The byte order mark at the beginning of the file tells us how to decode
+    # the rest.
+
+    encoding = "utf-16-be" if bom == codecs.BOM_UTF16_BE else "utf-16-le"
+    for row in csv.reader(io.StringIO(data.decode(encoding)),
+                          delimiter="\t"):
+        if row:
+            yield classify(row)
+
+
+def chunks(rows, chunk_size=CHUNK_SIZE):
+    """Yield the given rows as Tables of (at most) `chunk_size' responses."""
+
+    builder = TableBuilder(Response)
+    for row in rows:
+        builder.append(row)
+        if len(builder) == chunk_size:
+            yield builder.table()
+            builder = TableBuilder(Response)
+
+    if len(builder):
+        yield builder.table()
+
+
+def read_chunks(file_name, chunk_size=CHUNK_SIZE):
+    """Yield the survey responses in the given file as Tables of (at most)
+    `chunk_size' responses."""
+
+    return chunks(read_rows(file_name), chunk_size)
+
+
+def parse_data(file_name):
+    """Parse survey data from the given file into a Table."""
+
+    builder = TableBuilder(Response)
+    for row in read_rows(file_name):
+        builder.append(row)
+
+    log("Parsed %d survey responses." % len(builder))
+
+    return builder.table()
+
+
+def snapshot_key(file_name):
+    """
+    Return the key of the given export's snapshot, i.e., a hash over the
+    export's content and the settings that parse_data depends on.
+    """
+
+    digest = hashlib.sha256()
+    digest.update(("%d %s %s\n" % (METADATA_LINES,
+                                    MULTIPLE_CHOICE_RESPONSE.pattern,
+                                    ",".join(Response._fields))).encode())
+    with open(file_name, "rb") as fd:
+        for block in iter(lambda: fd.read(1 << 20), b""):
+            digest.update(block)
+
+    return digest.hexdigest()
+
+
+def load_data(file_name, use_snapshot=True):
+    """
+    Return the survey data in the given file.
+
+    The parsed data is saved in a snapshot next to the file, which later runs
+    memory-map instead of parsing the file again, as long as the file's
+    content did not change.
+    """
+
+    if not use_snapshot:
+        return parse_data(file_name)
+
+    try:
+        key = snapshot_key(file_name)
+    except OSError as err:
+        log(err)
+        sys.exit(1)
+
+    snapshot = file_name + SNAPSHOT_SUFFIX
+    table = Table.load(snapshot, Response, key)
+    if table is not None:
+        log("Loaded %d survey responses from snapshot '%s'." %
+            (len(table), snapshot))
+        return table
+
+    table = parse_data(file_name)
+    try:
+        table.save(snapshot, key)
+        log("Saved parsed survey responses to snapshot '%s'." % snapshot)
+    except OSError as err:
+        log("Cannot save snapshot: %s" % err)
+
+    return table
+
+
+# Segments of the population, i.e., subjects whose answers to a question are
+# all among the given answers, including subjects who skipped it:
+# - graduates have either an undergraduate or a graduate degree.
+# - experts are either highly knowledgeable or experts in Internet privacy and
+#   security.
+# - freq_users either use Tor Browser as their main browser or use Tor on
+#   average once a day.
+
+SEGMENTS = collections.OrderedDict([
+    ("graduates",  ("q1_5", ["3", "4"])),
+    ("experts",    ("q1_6", ["4", "5"])),
+    ("freq_users", ("q2_3", ["1", "6"]))])
+
+# A pruning rule returns which of a demographic's responses to keep.
+
+Rule = collections.namedtuple("Rule", ["name", "keep"])
+
+# Responses must have gotten at least MIN_CORRECT of the attention checks
+# correct to be considered valid.
+
+MIN_CORRECT = 2
+ATTENTION_CHECKS = [("q2_5",  ["3", "4"]),
+                    ("q3_12", "2"),
+                    ("q5_8",  "4"),
+                    ("q6_8",  "1")]
+
+
+def finished(d):
+    """Keep responses that finished the survey."""
+
+    return d.table.columns["finished"].contains("1", d.rows)
 
-    responses = responses[METADATA_LINES:]
 
-    log("Parsed %d survey responses." % len(responses))
+def attention_checks(d):
+    """Keep responses that got at least MIN_CORRECT attention checks."""
 
-    return responses
+    # Does the respondent's answer match the authoritative answer?
 
+    correct = np.zeros(len(d.rows), dtype=int)
+    for question, auth_answer in ATTENTION_CHECKS:
+        correct += d.table.columns[question].equals(auth_answer, d.rows)
 
-def prune_data(demographic):
+    return correct >= MIN_CORRECT
+
+
+def min_duration(seconds):
+    """Return a rule function that keeps responses that took at least the
+    given number of seconds."""
+
+    def keep(d):
+
+        return d.table.columns["duration"].numbers(d.rows) >= seconds
+
+    return keep
+
+
+# The rules that prune_data applies by default.  To also weed out responses
+# that were too quick, add, e.g., Rule("rushed responses", min_duration(120)).
+
+PRUNING_RULES = [Rule("non-finished responses", finished),
+                 Rule("failed attention checks", attention_checks)]
+
+
+def apply_rules(demographic, rules):
+    """
+    Return the responses of the given demographic that pass all rules, how
+    many responses are left after each rule, and how many responses each
+    rule rejects on its own.
+    """
+
+    keep = np.ones(len(demographic), dtype=bool)
+    left, rejected = [], []
+    for rule in rules:
+        passed = rule.keep(demographic)
+        keep &= passed
+        left.append(int(np.count_nonzero(keep)))
+        rejected.append(len(passed) - int(np.count_nonzero(passed)))
+
+    return Demographic(demographic.table, demographic.rows[keep]), \
+        left, rejected
+
+
+def log_pruning(orig_size, rules, left, rejected):
+
+    log("Starting with %d responses before pruning." % orig_size)
+    for rule, n, r in zip(rules, left, rejected):
+        log("%d (%.2f%%) responses left after pruning %s (%d rejected by "
+            "this rule alone)." % (n, float(n) / orig_size * 100,
+                                   rule.name, r))
+
+
+def prune_data(demographic, rules=PRUNING_RULES):
     """
     Weed out low-quality and incomplete responses.
 
     We employ a number of heuristics to remove responses that...
     - ...did not finish the survey.
     - ...did not get at least two out of four attention checks.
+
+    Every rule is evaluated over all responses at once.  We keep the
+    responses that pass all rules, and log how many responses each rule
+    rejects on its own.
     """
 
-    orig_size = len(demographic)
-    log("Starting with %d responses before pruning." % orig_size)
+    pruned, left, rejected = apply_rules(demographic, rules)
+    log_pruning(len(demographic), rules, left, rejected)
+
+    return pruned
+
+
+def segment(population):
+    """Return the SEGMENTS of the given population by name."""
+
+    return collections.OrderedDict(
+        (name, population.filter_subset(question, answers))
+        for name, (question, answers) in SEGMENTS.items())
+
+
+class Aggregate(object):
+    """
+    The running pruning counts and Summaries of the population and its
+    segments, to which we add chunks of responses as we read them.
+    """
+
+    def __init__(self, rules=PRUNING_RULES):
+
+        self.rules = rules
+        self.population = Summary()
+        self.segments = collections.OrderedDict((name, Summary())
+                                                for name in SEGMENTS)
+        self.orig_size = 0
+        self.left = [0] * len(rules)
+        self.rejected = [0] * len(rules)
+        self.last = None
 
-    # Weed out responses that did not finish the survey.
+    def add(self, table):
+        """Prune the given Table of responses and add it."""
 
-    demographic = demographic.filter("finished", "1")
-    log("%d (%.2f%%) responses left after pruning non-finished responses." %
-        (len(demographic), float(len(demographic)) / orig_size * 100))
+        chunk, left, rejected = apply_rules(Demographic(table), self.rules)
+        self.orig_size += len(table)
+        self.left = [x + y for x, y in zip(self.left, left)]
+        self.rejected = [x + y for x, y in zip(self.rejected, rejected)]
 
-    # Analyse attention checks.  Responses must have gotten at least two out of
-    # four attention checks correct to be considered valid.
+        chunk = chunk.indexed()
+        self.population.add(chunk)
+        for name, demographic in segment(chunk).items():
+            self.segments[name].add(demographic)
 
-    min_correct = 2
-    attention_checks = [("q2_5",  ["3", "4"]),
-                        ("q3_12", "2"),
-                        ("q5_8",  "4"),
-                        ("q6_8",  "1")]
+        last = table.response(len(table) - 1)
+        self.last = [last.id, last.recorded_date]
 
-    for response in demographic:
-        correct = 0
-        for question, auth_answer in attention_checks:
+    def log(self):
 
-            # Does the responden't answer match the authoritative answer?
+        log("Parsed %d survey responses." % self.orig_size)
+        log_pruning(self.orig_size, self.rules, self.left, self.rejected)
 
-            resp_answer = response.__getattribute__(question)
-            correct += resp_answer == auth_answer
-        if correct < min_correct:
-            demographic.remove(response)
+    def settings(self):
+        """Return what the aggregate depends on besides the responses."""
 
-    log("%d (%.2f%%) responses left after pruning failed attention checks." %
-        (len(demographic), float(len(demographic)) / orig_size * 100))
+        # Round-trip through JSON so that we can compare with saved settings.
+        # States from before segments were subsets have no "membership".
 
-    return demographic
+        return json.loads(json.dumps({"rules": [rule.name
+                                                for rule in self.rules],
+                                      "segments": SEGMENTS,
+                                      "membership": "subset",
+                                      "max_values": Summary.MAX_VALUES}))
+
+    def to_dict(self):
+
+        return {"orig_size": self.orig_size,
+                "left": self.left,
+                "rejected": self.rejected,
+                "last": self.last,
+                "population": self.population.to_dict(),
+                "segments": {name: summary.to_dict()
+                             for name, summary in self.segments.items()}}
+
+    @classmethod
+    def from_dict(cls, d, rules=PRUNING_RULES):
+
+        aggregate = cls(rules)
+        aggregate.orig_size = d["orig_size"]
+        aggregate.left = d["left"]
+        aggregate.rejected = d["rejected"]
+        aggregate.last = d["last"]
+        aggregate.population = Summary.from_dict(d["population"])
+        for name in aggregate.segments:
+            aggregate.segments[name] = Summary.from_dict(d["segments"][name])
+
+        return aggregate
+
+
+def summarise(file_name, chunk_size=CHUNK_SIZE, rules=PRUNING_RULES):
+    """
+    Read the survey responses in the given file chunk by chunk, and return
+    Summaries of the pruned population and its segments.  Only one chunk is
+    in memory at a time.
+    """
+
+    aggregate = Aggregate(rules)
+    for table in read_chunks(file_name, chunk_size):
+        aggregate.add(table)
+    aggregate.log()
+
+    return aggregate.population, aggregate.segments
+
+
+def prefix_hash(file_name, length):
+    """
+    Return the SHA-256 of the first and the last CHECK_BYTES of the first
+    `length' bytes of the given file, and of `length'.
+
+    Re-exports change the export's header, and edits that change the length
+    of a response shift the responses near the end, so this tells us if the
+    part that we read before changed, without reading all of it again.  Only
+    edits that keep the length of responses in the middle go unnoticed.
+    """
+
+    digest = hashlib.sha256(str(length).encode("ascii"))
+    with open(file_name, "rb") as fd:
+        digest.update(fd.read(min(length, CHECK_BYTES)))
+        start = max(CHECK_BYTES, length - CHECK_BYTES)
+        if start < length:
+            fd.seek(start)
+            digest.update(fd.read(length - start))
+
+    return digest.hexdigest()
+
+
+def update(file_name, state_file, chunk_size=CHUNK_SIZE,
+           rules=PRUNING_RULES):
+    """
+    Like summarise, but only read the responses that were appended to the
+    export since the last call with the same state file.
+
+    The state file remembers how many bytes of the export we read, a
+    prefix_hash over them, the last response we read, and the running
+    Aggregate.  If the export changed in any other way than by appending
+    responses, or the pruning rules or segments changed, we start over.
+    Besides the appended responses, we only read 2 * CHECK_BYTES bytes.
+    """
+
+    aggregate = Aggregate(rules)
+    try:
+        with open(state_file, "r") as fd:
+            state = json.load(fd)
+    except (OSError, ValueError):
+        state = None
+
+    size = os.path.getsize(file_name)
+    if state is not None and state["settings"] == aggregate.settings() and \
+            state["offset"] <= size and \
+            prefix_hash(file_name, state["offset"]) == state["hash"]:
+        aggregate = Aggregate.from_dict(state["aggregate"], rules)
+        log("Reading responses recorded after %s (%s) in '%s'." %
+            (aggregate.last[1], aggregate.last[0], file_name)
+            if aggregate.last else
+            "Reading new responses in '%s'." % file_name)
+        new = 0
+        for table in chunks(read_appended(file_name, state["offset"]),
+                            chunk_size):
+            aggregate.add(table)
+            new += len(table)
+        log("Added %d new survey responses." % new)
+    else:
+        if state is not None:
+            log("Export or settings changed since the last update.  "
+                "Starting over.")
+        for table in read_chunks(file_name, chunk_size):
+            aggregate.add(table)
+
+    aggregate.log()
+
+    temp_name = "%s.%d.tmp" % (state_file, os.getpid())
+    with open(temp_name, "w") as fd:
+        json.dump({"settings": aggregate.settings(),
+                   "offset": size,
+                   "hash": prefix_hash(file_name, size),
+                   "aggregate": aggregate.to_dict()}, fd)
+    os.replace(temp_name, state_file)
+
+    return aggregate.population, aggregate.segments
 
 
 def tor_usage(d):
@@ -513,52 +1118,379 @@ def onion_preference(d):
             print("- %s" % r.q3_21)
     '''
 
-def analyse():
-    """Analyse the data set."""
+# The report blocks in the order in which we run them, with the message that
+# we log before running them.
+
+REPORT_BLOCKS = collections.OrderedDict([
+    ("tor_usage", (tor_usage,
+                   "Analysing questions about Tor usage.")),
+    ("onion_usage", (onion_usage,
+                     "Analysing questions about onion site usage.")),
+    ("onion_operation", (onion_operation,
+                         "Analysing questions about onion site operation.")),
+    ("onion_impersonation", (onion_impersonation,
+                             "Analysing questions about onion site "
+                             "impersonation.")),
+    ("privacy_expectation", (privacy_expectation,
+                             "Analysing questions about privacy "
+                             "expectations.")),
+    ("demographic_info", (demographic_info,
+                          "Analysing demographic information.")),
+    ("onion_preference", (onion_preference,
+                          "Analyzing preference for regular sites vs onion "
+                          "sites."))])
+
+MATRIX_COLUMNS = ["block", "heading", "question", "answer", "label",
+                  "statistic"]
+
+
+class Recorder(object):
+    """
+    Runs a report block on a demographic and records its results instead of
+    printing them.
+
+    A recorder is passed to the block as both the demographic and stdout.
+    The values that the block asks for are attached to the line of output
+    that they end up in, which gives us their label, and to the latest
+    "Question" heading.  Percentages of questions that nobody answered are
+    NaN.
+
+    If `echo' is given, the block's output is written to it, with the
+    confidence intervals in `intervals' appended to their percentages.
+    """
+
+    def __init__(self, demographic, echo=None, intervals=None):
+
+        self.demographic = demographic
+        self.echo = echo
+        self.intervals = intervals or {}
+        self.pending = []
+        self.buffer = ""
+        self.heading = ""
+        self.rows = []
+
+    def __len__(self):
+
+        return len(self.demographic)
+
+    def pct(self, question, answer):
+
+        try:
+            value = self.demographic.pct(question, answer)
+        except ZeroDivisionError:
+            value = float("nan")
+        self.pending.append((question, answer, "pct", value))
+
+        return value
+
+    def count(self, question, answer):
+
+        value = self.demographic.count(question, answer)
+        self.pending.append((question, answer, "count", value))
+
+        return value
+
+    def write(self, text):
+
+        self.buffer += text
+        while "\n" in self.buffer:
+            line, self.buffer = self.buffer.split("\n", 1)
+            if self.echo is not None:
+                self.echo.write(line + "".join(
+                    " [%.2f%%, %.2f%%]" % self.intervals[(q, a)]
+                    for q, a, statistic, _ in self.pending
+                    if statistic == "pct" and (q, a) in self.intervals) +
+                    "\n")
+            if self.pending:
+                label = line.split("% ", 1)[-1].strip()
+                for question, answer, statistic, value in self.pending:
+                    self.rows.append((self.heading, question, answer, label,
+                                      statistic, value))
+                self.pending = []
+            elif line.strip() and line.strip() != "---":
+                self.heading = line.strip().rstrip(":")
+
+    def flush(self):
+
+        pass
+
+    def run(self, block):
+        """Run the given report block and return the recorded rows."""
 
-    if len(sys.argv) != 2:
-        log("Usage: %s FILE_NAME" % sys.argv[0])
-        return 1
+        with contextlib.redirect_stdout(self):
+            block(self)
 
-    population = prune_data(Demographic(parse_data(sys.argv[1])))
+        return self.rows
 
-    # Select subjects that have either an undergraduate or a graduate degree.
 
-    graduates = Demographic([r for r in population
-                             if set(r.q1_5).issubset(set(["3", "4"]))])
+# Every worker process gets the demographics to report on once, in
+# init_worker.
 
-    # Select subjects that are either highly knowledgeable or experts in
-    # Internet privacy and security.
+_groups = None
 
-    experts = Demographic([r for r in population
-                           if set(r.q1_6).issubset(set(["4", "5"]))])
 
-    # Select subjects that either use Tor Browser as their main browser or use
-    # Tor on average once a day.
+def init_worker(groups):
 
-    freq_users = Demographic([r for r in population
-                              if set(r.q2_3).issubset(set(["1", "6"]))])
+    global _groups
+    _groups = groups
 
-    log("Analysing questions about Tor usage.")
-    tor_usage(population)
 
-    log("Analysing questions about onion site usage.")
-    onion_usage(population)
+def run_block(task):
+    """Run the given (group, block) task and return its recorded rows."""
 
-    log("Analysing questions about onion site operation.")
-    onion_operation(population)
+    group, block = task
 
-    log("Analysing questions about onion site impersonation.")
-    onion_impersonation(population)
+    return group, block, Recorder(_groups[group]).run(REPORT_BLOCKS[block][0])
 
-    log("Analysing questions about privacy expectations.")
-    privacy_expectation(population)
 
-    log("Analysing demographic information.")
-    demographic_info(population)
+def report_matrix(groups, jobs=1):
+    """
+    Run every report block for every group, i.e., the population and its
+    segments, and return the rows of a matrix with one column per group.
+    """
+
+    tasks = [(group, block) for block in REPORT_BLOCKS for group in groups]
+    log("Running %d report blocks for %d groups." %
+        (len(REPORT_BLOCKS), len(groups)))
+
+    # We fork the workers so that they share the groups with us instead of
+    # receiving pickled copies.
+
+    if jobs > 1:
+        pool = multiprocessing.get_context("fork").Pool(jobs, init_worker,
+                                                        (groups,))
+        results = pool.map(run_block, tasks)
+        pool.close()
+        pool.join()
+    else:
+        init_worker(groups)
+        results = [run_block(task) for task in tasks]
+
+    # Blocks ask for the same values for every group, so we join the groups'
+    # results row by row.
+
+    matrix = collections.OrderedDict()
+    for group, block, rows in results:
+        for row in rows:
+            matrix.setdefault((block,) + row[:-1], {})[group] = row[-1]
+
+    return [list(key) + [values.get(group) for group in groups]
+            for key, values in matrix.items()]
+
+
+def add_intervals(groups, rows, replicates, confidence, jobs, seed):
+    """
+    Return the given matrix rows with the bootstrap confidence interval of
+    every percentage next to it, and the names of the matrix's value
+    columns.
+    """
+
+    pairs = sorted(set(tuple(row[2:4]) for row in rows if row[5] == "pct"))
+    intervals = {}
+    for group, demographic in groups.items():
+        log("Bootstrapping %d percentages of %s with %d replicates." %
+            (len(pairs), group, replicates))
+        intervals[group] = bootstrap.intervals(demographic, pairs,
+                                               replicates, confidence, jobs,
+                                               seed)
+
+    columns = []
+    for group in groups:
+        columns += [group, group + "_low", group + "_high"]
+
+    extended = []
+    for row in rows:
+        extended.append(row[:6])
+        for group, value in zip(groups, row[6:]):
+            low, high = intervals[group][tuple(row[2:4])] \
+                if row[5] == "pct" else (None, None)
+            extended[-1] += [value, low, high]
+
+    return extended, columns
 
-    log("Analyzing preference for regular sites vs onion sites.")
-    onion_preference(population)
+
+def write_matrix(file_name, columns, rows):
+    """Write the given matrix, whose value columns have the given names, as
+    JSON if the file name ends in .json, and as CSV otherwise.  NaN becomes
+    null or an empty field, respectively."""
+
+    def clean(value):
+
+        return None if isinstance(value, float) and math.isnan(value) \
+            else value
+
+    with open(file_name, "w") as fd:
+        if file_name.endswith(".json"):
+            json.dump({"columns": list(columns),
+                       "rows": [dict(zip(MATRIX_COLUMNS, row[:6]),
+                                     values=dict(zip(columns, map(clean,
+                                                                  row[6:]))))
+                                for row in rows]}, fd, indent=1)
+            return
+
+        writer = csv.writer(fd, lineterminator="\n")
+        writer.writerow(MATRIX_COLUMNS + list(columns))
+        for row in rows:
+            writer.writerow(["" if clean(v) is None else v for v in row])
+
+
+def parse_segment(arg):
+    """Parse a NAME=QUESTION:ANSWER[,ANSWER...] segment definition."""
+
+    try:
+        name, definition = arg.split("=", 1)
+        question, answers = definition.split(":", 1)
+    except ValueError:
+        raise argparse.ArgumentTypeError("Expected NAME=QUESTION:ANSWERS, "
+                                         "e.g., women=q1_3:1")
+    if question not in Response._fields:
+        raise argparse.ArgumentTypeError("Unknown question '%s'." % question)
+
+    return name, (question, answers.split(","))
+
+
+def analyse():
+    """Analyse the data set."""
+
+    parser = argparse.ArgumentParser(description="Analyse TSV-formatted "
+                                     "Qualtrics survey data.")
+    parser.add_argument("file_name", metavar="FILE_NAME",
+                        help="UTF-16 TSV export of the survey.")
+    parser.add_argument("--no-snapshot", action="store_true",
+                        help="Parse the export even if it has an up-to-date "
+                        "snapshot, and don't save one.")
+    parser.add_argument("--stream", action="store_true",
+                        help="Read the export in chunks and only keep answer "
+                        "counts in memory.  Implies --no-snapshot.")
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE,
+                        help="Number of responses per chunk in --stream mode "
+                        "(default: %(default)d).")
+    parser.add_argument("-s", "--segment", action="append", default=[],
+                        type=parse_segment,
+                        metavar="NAME=QUESTION:ANSWER[,ANSWER...]",
+                        help="Add a segment of respondents whose answers "
+                        "are all among the given ones, e.g., "
+                        "women=q1_3:1.  May be given several times.")
+    parser.add_argument("-m", "--matrix", metavar="FILE",
+                        help="Run every report block for the population and "
+                        "all segments, and write a matrix of the results to "
+                        "the given CSV (or .json) file instead of printing "
+                        "the population's reports.")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="Number of worker processes for --matrix and "
+                        "--bootstrap (default: 1).")
+    parser.add_argument("-b", "--bootstrap", type=int, default=0,
+                        metavar="REPLICATES",
+                        help="Add bootstrap confidence intervals with the "
+                        "given number of replicates to every percentage.  "
+                        "Does not work with --stream.")
+    parser.add_argument("--confidence", type=float,
+                        default=bootstrap.DEFAULT_CONFIDENCE,
+                        help="Confidence level of the bootstrap intervals "
+                        "(default: %(default).2f).")
+    parser.add_argument("--seed", type=int,
+                        help="Seed for the bootstrap's random numbers.")
+    parser.add_argument("-i", "--incremental", metavar="STATE_FILE",
+                        help="Like --stream, but only read the responses "
+                        "that were appended to the export since the last "
+                        "run with the given state file, and update the "
+                        "counts in it.")
+    parser.add_argument("--profile", metavar="FILE",
+                        help="Record the wall-clock time, CPU time, and peak "
+                        "memory of every stage and report block, and how "
+                        "often Demographic.filter and frac were called, and "
+                        "write them as JSON to the given file.")
+    parser.add_argument("--cprofile", metavar="FILE",
+                        help="With --profile, also run every stage under "
+                        "cProfile and dump the statistics of the slowest "
+                        "stage to the given file.")
+    args = parser.parse_args()
+    SEGMENTS.update(args.segment)
+    if args.bootstrap and (args.stream or args.incremental):
+        parser.error("--bootstrap needs all responses, so it does not work "
+                     "with --stream or --incremental.")
+    if args.cprofile and not args.profile:
+        parser.error("--cprofile needs --profile.")
+
+    # Workers of --jobs are not profiled, so their stages' calls are not
+    # counted.
+
+    profiler = Profiler(args.profile is not None, args.cprofile)
+    profiler.count(Demographic, "filter")
+    profiler.count(Demographic, "frac")
+    profiler.count(Summary, "frac")
+    profiler.count(sys.modules[__name__], "classify", "classify")
+    profiler.open()
+    try:
+        return run(args, profiler)
+    finally:
+        profiler.close()
+        if args.profile:
+            profiler.save(args.profile)
+            log("Wrote profile to '%s'." % args.profile)
+
+
+def run(args, profiler):
+    """Run the analysis that the given command line arguments ask for, and
+    record its stages with the given Profiler."""
+
+    if args.incremental:
+        with profiler.stage("update"):
+            population, segments = update(args.file_name, args.incremental,
+                                          args.chunk_size)
+    elif args.stream:
+        with profiler.stage("summarise"):
+            population, segments = summarise(args.file_name,
+                                             args.chunk_size)
+    else:
+        with profiler.stage("load_data"):
+            table = load_data(args.file_name, not args.no_snapshot)
+        with profiler.stage("prune_data"):
+            population = prune_data(Demographic(table))
+        with profiler.stage("indexed"):
+            population = population.indexed()
+        with profiler.stage("segment"):
+            segments = segment(population)
+
+    if args.matrix:
+        groups = collections.OrderedDict([("population", population)])
+        groups.update(segments)
+        with profiler.stage("report_matrix"):
+            rows, columns = report_matrix(groups, args.jobs), list(groups)
+        if args.bootstrap:
+            with profiler.stage("bootstrap"):
+                rows, columns = add_intervals(groups, rows, args.bootstrap,
+                                              args.confidence, args.jobs,
+                                              args.seed)
+        with profiler.stage("write_matrix"):
+            write_matrix(args.matrix, columns, rows)
+        log("Wrote report matrix to '%s'." % args.matrix)
+        return 0
+
+    # To print confidence intervals, we first record which percentages the
+    # report blocks print.
+
+    intervals = {}
+    if args.bootstrap:
+        with profiler.stage("bootstrap"):
+            pairs = set((question, answer)
+                        for block, _ in REPORT_BLOCKS.values()
+                        for _, question, answer, _, statistic, _ in
+                        Recorder(population).run(block)
+                        if statistic == "pct")
+            log("Bootstrapping %d percentages with %d replicates." %
+                (len(pairs), args.bootstrap))
+            intervals = bootstrap.intervals(population, sorted(pairs),
+                                            args.bootstrap, args.confidence,
+                                            args.jobs, args.seed)
+
+    for name, (block, message) in REPORT_BLOCKS.items():
+        log(message)
+        with profiler.stage("report:%s" % name):
+            if args.bootstrap:
+                Recorder(population, sys.stdout, intervals).run(block)
+            else:
+                block(population)
 
     return 0
 
@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+#
+# Time the stages of the survey analysis on synthetic exports.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+For every size, we write a synthetic export with synthetic_survey, unless
+the data directory already has one, and time parse_data, prune_data,
+indexing, segment, Demographic.filter and pct for all (question, answer)
+pairs that the reports ask for, and every report block.  Stages that use
+caches get a fresh demographic for every run.
+
+Every stage and size becomes one JSON line, e.g.,
+
+  {"benchmark": "survey", "stage": "parse_data", "size": 1000,
+   "density": 0.25, "seed": 1, "runs": 3, "wall": 0.41, "cpu": 0.40}
+
+where "wall" and "cpu" are the wall-clock and CPU seconds of the fastest
+run.  Lines are appended to the output file, so that runs of several
+versions can be compared.
+"""
+
+import io
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import contextlib
+
+from analyse_survey_data import log, parse_data, prune_data, segment, \
+    Demographic, Recorder, REPORT_BLOCKS
+from synthetic_survey import write_survey, DEFAULT_DENSITY
+
+DEFAULT_SIZES = [1000, 10000, 100000, 1000000]
+DEFAULT_SEED = 1
+
+STAGES = ["parse_data", "prune_data", "indexed", "segment", "filter",
+          "pct"] + ["report:%s" % block for block in REPORT_BLOCKS]
+
+
+def measure(function, setup=None, runs=1):
+    """
+    Call function(setup()) the given number of times, and return the
+    wall-clock and CPU seconds of the fastest call, and its result.  The
+    analysis' log messages are discarded.
+    """
+
+    best = None
+    for _ in range(runs):
+        argument = setup() if setup is not None else None
+        with contextlib.redirect_stderr(io.StringIO()):
+            wall, cpu = time.perf_counter(), time.process_time()
+            result = function(argument)
+            wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+        if best is None or wall < best[0]:
+            best = (wall, cpu)
+
+    return best[0], best[1], result
+
+
+def survey_file(data_dir, size, density, seed):
+    """Return the name of a synthetic export with the given parameters,
+    writing it if it does not exist yet."""
+
+    file_name = os.path.join(data_dir, "survey-%d-%g-%d.tsv" % (size, density,
+                                                                seed))
+    if not os.path.exists(file_name):
+        log("Writing %d synthetic responses to '%s'." % (size, file_name))
+        write_survey(file_name + ".tmp", size, density, seed)
+        os.replace(file_name + ".tmp", file_name)
+
+    return file_name
+
+
+def report_pairs(population):
+    """Return the (question, answer) pairs whose percentages the report
+    blocks print."""
+
+    pairs = []
+    with contextlib.redirect_stderr(io.StringIO()):
+        for block, _ in REPORT_BLOCKS.values():
+            for _, question, answer, _, statistic, _ in \
+                    Recorder(population).run(block):
+                if statistic == "pct" and (question, answer) not in pairs:
+                    pairs.append((question, answer))
+
+    return pairs
+
+
+def percentages(demographic, pairs):
+
+    for question, answer in pairs:
+        try:
+            demographic.pct(question, answer)
+        except ZeroDivisionError:
+            pass
+
+
+def benchmark(file_name, stages, runs):
+    """
+    Yield (stage, wall-clock seconds, CPU seconds) for the given stages on
+    the given export.  Stages whose results later stages need always run,
+    but only once unless they are timed.
+    """
+
+    def runs_of(stage):
+
+        return runs if stage in stages else 1
+
+    wall, cpu, table = measure(lambda _: parse_data(file_name),
+                               runs=runs_of("parse_data"))
+    if "parse_data" in stages:
+        yield "parse_data", wall, cpu
+
+    wall, cpu, population = measure(lambda _: prune_data(Demographic(table)),
+                                    runs=runs_of("prune_data"))
+    if "prune_data" in stages:
+        yield "prune_data", wall, cpu
+
+    def fresh():
+
+        return Demographic(table, population.rows)
+
+    wall, cpu, indexed = measure(lambda d: d.indexed(), fresh,
+                                 runs_of("indexed"))
+    if "indexed" in stages:
+        yield "indexed", wall, cpu
+
+    if "segment" in stages:
+        wall, cpu, _ = measure(lambda _: segment(indexed), runs=runs)
+        yield "segment", wall, cpu
+
+    pairs = report_pairs(fresh())
+    if "filter" in stages:
+        wall, cpu, _ = measure(lambda _: [indexed.filter(question, answer)
+                                          for question, answer in pairs],
+                               runs=runs)
+        yield "filter", wall, cpu
+
+    if "pct" in stages:
+        wall, cpu, _ = measure(lambda d: percentages(d, pairs), fresh, runs)
+        yield "pct", wall, cpu
+
+    for block, (function, _) in REPORT_BLOCKS.items():
+        stage = "report:%s" % block
+        if stage in stages:
+            wall, cpu, _ = measure(lambda d: Recorder(d).run(function),
+                                   fresh, runs)
+            yield stage, wall, cpu
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Time the stages of the "
+                                     "survey analysis on synthetic exports.")
+    parser.add_argument("-n", "--sizes", type=int, nargs="+",
+                        default=DEFAULT_SIZES,
+                        help="Numbers of respondents (default: %s)." %
+                        " ".join(str(n) for n in DEFAULT_SIZES))
+    parser.add_argument("-d", "--density", type=float,
+                        default=DEFAULT_DENSITY,
+                        help="Probability that a respondent selects an "
+                        "option of a multiple-choice question (default: "
+                        "%(default).2f).")
+    parser.add_argument("--seed", type=int, default=DEFAULT_SEED,
+                        help="Seed for the synthetic exports (default: "
+                        "%(default)d).")
+    parser.add_argument("-r", "--runs", type=int, default=3,
+                        help="Number of runs per stage, of which we report "
+                        "the fastest (default: %(default)d).")
+    parser.add_argument("-s", "--stage", action="append", choices=STAGES,
+                        help="Stage to time; may be given several times "
+                        "(default: all).")
+    parser.add_argument("--data-dir", default=tempfile.gettempdir(),
+                        help="Directory for the synthetic exports, which "
+                        "are reused across runs (default: %(default)s).")
+    parser.add_argument("-o", "--output",
+                        help="File to append JSON lines to (default: "
+                        "stdout).")
+    args = parser.parse_args()
+
+    stages = args.stage or STAGES
+    fd = open(args.output, "a") if args.output else sys.stdout
+    for size in args.sizes:
+        file_name = survey_file(args.data_dir, size, args.density, args.seed)
+        for stage, wall, cpu in benchmark(file_name, stages, args.runs):
+            log("%s on %d responses: %.3fs." % (stage, size, wall))
+            fd.write(json.dumps({"benchmark": "survey", "stage": stage,
+                                 "size": size, "density": args.density,
+                                 "seed": args.seed, "runs": args.runs,
+                                 "wall": wall, "cpu": cpu}) + "\n")
+            fd.flush()
+    if fd is not sys.stdout:
+        fd.close()
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
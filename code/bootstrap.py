@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+#
+# Bootstrap confidence intervals for the percentages in survey reports.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Every replicate resamples a demographic's respondents with replacement.
+
+Instead of calling Demographic.pct per replicate and answer, we draw a whole
+batch of replicates as one index matrix and turn it into a matrix W of how
+often each respondent was drawn.  With A telling which respondents selected
+each answer and E which respondents answered its question at all, the
+fractions of all answers in all replicates of the batch are W @ A / W @ E.
+Batches are independent, so they can be spread over processes.
+"""
+
+import warnings
+import multiprocessing
+import numpy as np
+
+DEFAULT_REPLICATES = 1000
+DEFAULT_CONFIDENCE = 0.95
+# Replicates are drawn in batches of up to BATCH_SIZE replicates, and of up
+# to MAX_BATCH_DRAWS draws in total.
+
+BATCH_SIZE = 100
+MAX_BATCH_DRAWS = 10 ** 7
+
+
+def indicators(demographic, pairs):
+    """
+    Return two respondent x pair matrices for the given (question, answer)
+    pairs: which respondents selected the answer, and which gave a non-empty
+    answer to the question.
+    """
+
+    rows = demographic.rows
+    selected = np.zeros((len(rows), len(pairs)), dtype=np.float32)
+    answered = np.zeros((len(rows), len(pairs)), dtype=np.float32)
+    for k, (question, answer) in enumerate(pairs):
+        column = demographic.table.columns[question]
+        selected[:, k] = column.contains(answer, rows)
+        answered[:, k] = ~column.equals("", rows)
+
+    return selected, answered
+
+
+# Every worker process gets the indicator matrices once, in init_worker.
+
+_selected = None
+_answered = None
+
+
+def init_worker(selected, answered):
+
+    global _selected, _answered
+    _selected, _answered = selected, answered
+
+
+def resample(task):
+    """Return a replicate x pair matrix of fractions for the given (seed,
+    number of replicates) task."""
+
+    seed, replicates = task
+    n = len(_selected)
+    rng = np.random.default_rng(seed)
+
+    # Count how often every respondent is drawn in every replicate.
+
+    draws = rng.integers(0, n, size=(replicates, n))
+    draws += np.arange(replicates)[:, np.newaxis] * n
+    weights = np.bincount(draws.ravel(), minlength=replicates * n)
+    weights = weights.reshape(replicates, n).astype(np.float32)
+
+    # The counts are exact in single precision, but we divide them in double
+    # precision.
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return (weights @ _selected).astype(float) / (weights @ _answered)
+
+
+def intervals(demographic, pairs, replicates=DEFAULT_REPLICATES,
+              confidence=DEFAULT_CONFIDENCE, jobs=1, seed=None):
+    """
+    Return a dictionary that maps the given (question, answer) pairs to the
+    bootstrap percentile interval of their percentage in the given
+    demographic.  Replicates in which nobody answered the question are
+    ignored, and intervals without any replicate are (NaN, NaN).
+    """
+
+    pairs = list(pairs)
+    if not len(demographic) or not pairs:
+        return {pair: (float("nan"), float("nan")) for pair in pairs}
+
+    # Batches get independent seeds, so that the result does not depend on
+    # the number of processes.
+
+    batch = max(1, min(BATCH_SIZE, MAX_BATCH_DRAWS // len(demographic)))
+    sizes = [batch] * (replicates // batch)
+    if replicates % batch:
+        sizes.append(replicates % batch)
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+    tasks = list(zip(seeds, sizes))
+
+    selected, answered = indicators(demographic, pairs)
+    if jobs > 1:
+        pool = multiprocessing.Pool(jobs, init_worker, (selected, answered))
+        fractions = pool.map(resample, tasks)
+        pool.close()
+        pool.join()
+    else:
+        init_worker(selected, answered)
+        fractions = [resample(task) for task in tasks]
+
+    # NumPy warns about pairs without any replicate, which we expect.
+
+    alpha = (1.0 - confidence) / 2
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)
+        low, high = np.nanquantile(np.vstack(fractions) * 100,
+                                   [alpha, 1.0 - alpha], axis=0)
+
+    return {pair: (float(l), float(h)) for pair, l, h in zip(pairs, low,
+                                                             high)}
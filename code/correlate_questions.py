@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+#
+# Correlate the answers to all pairs of survey questions.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Regenerates analysis_results/correlation_values.csv and response_counts.csv.
+
+For every ordered pair of questions (x, y), we fit a linear regression of y
+on x over the respondents that gave a numeric answer to both, and report the
+correlation coefficient, the two-sided p-value, and the slope's standard
+error, like SciPy's linregress did.  All pairs are computed at once: with X
+holding the answers (zero if missing) and M telling which answers exist, the
+pairwise sums are the matrix products of X, X**2, and M.
+"""
+
+import re
+import os
+import sys
+import csv
+import argparse
+import numpy as np
+from scipy import special
+
+from analyse_survey_data import log, load_data, prune_data, Demographic
+
+# The questions in correlation_values.csv and response_counts.csv.
+
+CORRELATED_QUESTIONS = [
+    "duration", "q1_3", "q1_4", "q1_5", "q1_6", "q2_2", "q2_3", "q2_5",
+    "q3_3", "q3_4", "q3_7", "q3_9", "q3_10", "q3_11", "q3_12", "q3_13",
+    "q3_14", "q3_16_1", "q3_16_2", "q3_16_3", "q3_16_4", "q3_18", "q3_20",
+    "q3_22_1", "q3_22_2", "q3_22_3", "q3_22_4", "q3_22_5", "q3_22_6", "q4_2",
+    "q4_3", "q4_6_1", "q4_6_3", "q4_6_2", "q5_2", "q5_5", "q5_7", "q5_8",
+    "q5_9", "q6_4", "q6_6", "q6_8"]
+
+COUNTED_QUESTIONS = [
+    "duration", "q1_3", "q1_4", "q1_5", "q1_6", "q2_2", "q2_3", "q3_3",
+    "q3_4", "q3_7", "q3_10", "q3_11", "q3_12", "q3_14", "q3_16_1", "q3_16_2",
+    "q3_16_3", "q3_16_4", "q3_18", "q3_20", "q3_22_1", "q3_22_2", "q3_22_3",
+    "q3_22_4", "q3_22_5", "q3_22_6", "q4_2", "q4_3", "q4_6_1", "q4_6_3",
+    "q4_6_2", "q5_2", "q5_5", "q5_7", "q5_8", "q5_9", "q6_4", "q6_6", "q6_8",
+    "q6_10_1", "q6_10_2", "q6_10_3"]
+
+# Keeps the t statistic finite for perfect correlations.
+
+TINY = 1.0e-20
+
+
+def question_number(question):
+    """Turn a field name such as q3_16_2 into a question number: q3.16_2."""
+
+    return re.sub(r"^q(\d+)_", r"q\1.", question)
+
+
+def format_number(x):
+    """Format the given number like Python 2's str(), which the CSV files in
+    analysis_results were written with."""
+
+    s = "%.12g" % x
+    if re.match(r"^-?\d+$", s):
+        s += ".0"
+
+    return s
+
+
+def answer_matrix(demographic, questions):
+    """
+    Return a respondent x question matrix of numeric answers, with zeros for
+    answers that are missing or not numeric, and a matrix of the same shape
+    that tells which answers exist.
+    """
+
+    X = np.column_stack([demographic.table.columns[q].numbers(demographic.rows)
+                         for q in questions])
+    M = ~np.isnan(X)
+    X[~M] = 0.0
+
+    return X, M.astype(float)
+
+
+def regress_all(X, M):
+    """
+    Return matrices of the correlation coefficient, p-value, and standard
+    error of the slope of regressing question j on question i over the
+    respondents that answered both.
+    """
+
+    n = M.T @ M
+    sx = X.T @ M
+    sy = sx.T
+    sxx = (X * X).T @ M
+    syy = sxx.T
+    sxy = X.T @ X
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        ssxm = sxx - sx * sx / n
+        ssym = syy - sy * sy / n
+        ssxym = sxy - sx * sy / n
+
+        # Like linregress, we say that pairs without variance are
+        # uncorrelated, and clip rounding errors.
+
+        r_den = np.sqrt(ssxm * ssym)
+        r = np.where(r_den == 0.0, 0.0, ssxym / r_den)
+        r = np.clip(r, -1.0, 1.0)
+
+        df = n - 2
+        t = r * np.sqrt(df / ((1.0 - r + TINY) * (1.0 + r + TINY)))
+        p = 2 * special.stdtr(df, -np.abs(t))
+        stderr = np.sqrt((1 - r * r) * ssym / ssxm / df)
+
+    return r, p, stderr
+
+
+def write_correlations(file_name, questions, r, p, stderr):
+
+    with open(file_name, "w") as fd:
+        writer = csv.writer(fd, lineterminator="\n")
+        writer.writerow(["questions numbers", "r value", "p value",
+                         "std err"])
+        for i, x in enumerate(questions):
+            for j, y in enumerate(questions):
+                writer.writerow(["%s_%s" % (question_number(x),
+                                            question_number(y)),
+                                 format_number(r[i, j]),
+                                 format_number(p[i, j]),
+                                 format_number(stderr[i, j])])
+
+
+def write_response_counts(file_name, questions, M):
+
+    with open(file_name, "w") as fd:
+        writer = csv.writer(fd, lineterminator="\n")
+        writer.writerow(["question number", "number of responses"])
+        for question, count in zip(questions, M.sum(axis=0).astype(int)):
+            writer.writerow([question_number(question), count])
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Correlate the answers to "
+                                     "all pairs of survey questions.")
+    parser.add_argument("file_name", metavar="FILE_NAME",
+                        help="UTF-16 TSV export of the survey.")
+    parser.add_argument("-o", "--output-dir", default=os.path.join(
+                        os.path.dirname(os.path.abspath(__file__)),
+                        os.pardir, "analysis_results"),
+                        help="Directory to write correlation_values.csv and "
+                        "response_counts.csv to (default: "
+                        "../analysis_results).")
+    args = parser.parse_args()
+
+    population = prune_data(Demographic(load_data(args.file_name)))
+
+    log("Correlating %d pairs of questions." % len(CORRELATED_QUESTIONS) ** 2)
+    X, M = answer_matrix(population, CORRELATED_QUESTIONS)
+    file_name = os.path.join(args.output_dir, "correlation_values.csv")
+    write_correlations(file_name, CORRELATED_QUESTIONS, *regress_all(X, M))
+    log("Wrote '%s'." % file_name)
+
+    _, M = answer_matrix(population, COUNTED_QUESTIONS)
+    file_name = os.path.join(args.output_dir, "response_counts.csv")
+    write_response_counts(file_name, COUNTED_QUESTIONS, M)
+    log("Wrote '%s'." % file_name)
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
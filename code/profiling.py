@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+#
+# Per-stage timing and memory instrumentation for the survey analysis.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+A Profiler records the wall-clock time, CPU time, and peak memory of every
+stage of a run, e.g., parsing, pruning, or a report block, and how often
+selected functions were called in each stage and how long they took.
+
+Memory is measured with tracemalloc, which sees Python's and NumPy's
+allocations, but not memory-mapped snapshots, and slows down allocations.
+Calls are counted by replacing the functions with wrappers for as long as
+the profiler is open.  Neither is in place unless we profile.
+
+With `cprofile', every stage also runs under cProfile, and the statistics
+of the slowest stage are dumped to the given file, e.g., for snakeviz or
+pstats.  cProfile inflates the recorded times.
+"""
+
+import json
+import time
+import cProfile
+import functools
+import contextlib
+import tracemalloc
+
+
+class Profiler(object):
+    """Records stages and calls when enabled, and does nothing otherwise."""
+
+    def __init__(self, enabled=False, cprofile=None):
+
+        self.enabled = enabled
+        self.cprofile = cprofile
+        self.stages = []
+        self.current = None
+        self.patched = []
+        self.profiles = {}
+
+    def count(self, owner, name, label=None):
+        """Count the calls of the given attribute of a class or module, e.g.,
+        count(Demographic, "filter")."""
+
+        if not self.enabled:
+            return
+
+        function = getattr(owner, name)
+        label = label or "%s.%s" % (getattr(owner, "__name__", owner), name)
+
+        @functools.wraps(function)
+        def counted(*args, **kwargs):
+
+            if self.current is None:
+                return function(*args, **kwargs)
+
+            calls = self.current["calls"].setdefault(label, {"calls": 0,
+                                                             "seconds": 0.0})
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                calls["calls"] += 1
+                calls["seconds"] += time.perf_counter() - start
+
+        self.patched.append((owner, name, function))
+        setattr(owner, name, counted)
+
+    def open(self):
+
+        if self.enabled:
+            tracemalloc.start()
+
+    def close(self):
+        """Restore the counted functions and stop tracing memory."""
+
+        for owner, name, function in reversed(self.patched):
+            setattr(owner, name, function)
+        self.patched = []
+        if self.enabled and tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """Record the code in the with block as the given stage.  Stages do
+        not nest."""
+
+        if not self.enabled:
+            yield
+            return
+
+        self.current = {"stage": name, "calls": {}}
+        memory, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        profile = cProfile.Profile() if self.cprofile else None
+
+        wall, cpu = time.perf_counter(), time.process_time()
+        if profile is not None:
+            profile.enable()
+        try:
+            yield
+        finally:
+            if profile is not None:
+                profile.disable()
+            wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+            current, peak = tracemalloc.get_traced_memory()
+
+            self.current.update({"wall": wall, "cpu": cpu,
+                                 "peak_memory": peak - memory,
+                                 "memory": current - memory})
+            self.stages.append(self.current)
+            self.current = None
+            if profile is not None:
+                self.profiles[len(self.stages) - 1] = profile
+
+    def hottest(self):
+        """Return the slowest stage, or None if there is none."""
+
+        return max(self.stages, key=lambda stage: stage["wall"]) \
+            if self.stages else None
+
+    def save(self, file_name):
+        """Write the recorded stages as JSON to the given file, and dump the
+        cProfile statistics of the slowest stage, if any."""
+
+        hottest = self.hottest()
+        result = {"stages": self.stages,
+                  "total": {"wall": sum(s["wall"] for s in self.stages),
+                            "cpu": sum(s["cpu"] for s in self.stages)},
+                  "hottest": hottest["stage"] if hottest else None}
+
+        if self.cprofile and hottest is not None:
+            self.profiles[self.stages.index(hottest)].dump_stats(
+                self.cprofile)
+            result["cprofile"] = self.cprofile
+
+        with open(file_name, "w") as fd:
+            json.dump(result, fd, indent=2)
+            fd.write("\n")
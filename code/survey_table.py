@@ -0,0 +1,514 @@
+#!/usr/bin/env python3
+#
+# Columnar storage of parsed survey responses.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Every question is stored as a NumPy array instead of one tuple per response.
+
+Answers are coded as small integers that index the question's list of
+distinct answers.  Questions with multiple choices store one bitmask per
+response instead, with one bit per distinct answer.  Multiple-choice answers
+are therefore compared as sets, i.e., regardless of their order.
+"""
+
+import os
+import json
+import array
+import numpy as np
+
+# Snapshots of parsed tables start with this line.  Their arrays are aligned
+# so that they can be memory-mapped.
+
+SNAPSHOT_MAGIC = b"SURVEY-TABLE 1\n"
+SNAPSHOT_ALIGNMENT = 64
+
+
+def code_type(size):
+    """Return the smallest unsigned integer type that can hold `size' codes."""
+
+    for t in (np.uint8, np.uint16, np.uint32):
+        if size <= np.iinfo(t).max + 1:
+            return t
+
+    return np.uint64
+
+
+class Column(object):
+    """
+    The answers to one question.
+
+    `values' holds the question's distinct answers.  For single-choice
+    questions, `codes' holds the index of every response's answer in
+    `values'.  For multiple-choice questions, `bits' holds a packed bitmask
+    per response whose bit k is set if the response selected values[k], and
+    `lists' tells responses that selected a list of answers apart from
+    responses that gave a single answer.
+
+    All methods take an array of the row numbers to consider.
+    """
+
+    def __init__(self, values, codes=None, bits=None, lists=None):
+
+        self.values = values
+        self.lookup = {v: k for k, v in enumerate(values)}
+        self.codes = codes
+        self.bits = bits
+        self.lists = lists
+
+    def __len__(self):
+
+        return len(self.codes if self.bits is None else self.bits)
+
+    @property
+    def multiple(self):
+
+        return self.bits is not None
+
+    def has(self, k, rows):
+        """Return which of the given rows have bit k set."""
+
+        return (self.bits[rows, k >> 3] >> (k & 7)) & 1 == 1
+
+    def contains(self, answer, rows):
+        """Return which of the given rows selected the given answer."""
+
+        k = self.lookup.get(answer) if isinstance(answer, str) else None
+        if k is None:
+            return np.zeros(len(rows), dtype=bool)
+        if self.multiple:
+            return self.has(k, rows)
+
+        return self.codes[rows] == k
+
+    def equals(self, answer, rows):
+        """
+        Return which of the given rows gave exactly the given answer, which
+        is either a string or a list of strings.
+        """
+
+        if isinstance(answer, str):
+            k = self.lookup.get(answer)
+            if k is None:
+                return np.zeros(len(rows), dtype=bool)
+            if self.multiple:
+                return ~self.lists[rows] & self.has(k, rows)
+            return self.codes[rows] == k
+
+        if not self.multiple or any(a not in self.lookup for a in answer):
+            return np.zeros(len(rows), dtype=bool)
+
+        mask = np.zeros(self.bits.shape[1] * 8, dtype=bool)
+        mask[[self.lookup[a] for a in answer]] = True
+        mask = np.packbits(mask, bitorder="little")
+
+        return self.lists[rows] & np.all(self.bits[rows] == mask, axis=1)
+
+    def numbers(self, rows):
+        """
+        Return the answers of the given rows as floats.  Answers that are not
+        numbers, including lists of several answers, become NaN.
+        """
+
+        numbers = []
+        for value in self.values:
+            try:
+                numbers.append(float(value))
+            except ValueError:
+                numbers.append(np.nan)
+        numbers = np.array(numbers + [np.nan])
+
+        if not self.multiple:
+            return numbers[self.codes[rows]]
+
+        # Responses that gave a single answer have exactly one bit set, and
+        # the others get the NaN at the end of `numbers'.
+
+        bits = np.unpackbits(self.bits[rows], axis=1,
+                             bitorder="little")[:, :len(self.values)]
+        codes = np.argmax(bits, axis=1)
+        single = ~self.lists[rows] & (bits.sum(axis=1) == 1)
+
+        return numbers[np.where(single, codes, len(self.values))]
+
+    def value(self, row):
+        """Return the answer of the given row as a string or list."""
+
+        if not self.multiple:
+            return self.values[self.codes[row]]
+
+        answers = [self.values[k] for k in
+                   np.flatnonzero(np.unpackbits(self.bits[row],
+                                                bitorder="little"))]
+
+        return answers if self.lists[row] else answers[0]
+
+    def decode(self, rows):
+        """Return the answers of the given rows as a list."""
+
+        if not self.multiple:
+            return [self.values[c] for c in self.codes[rows].tolist()]
+
+        bits = np.unpackbits(self.bits[rows], axis=1, bitorder="little")
+        _, ks = np.nonzero(bits)
+        ends = np.cumsum(np.count_nonzero(bits, axis=1)).tolist()
+        ks = ks.tolist()
+
+        decoded = []
+        start = 0
+        for end, is_list in zip(ends, self.lists[rows].tolist()):
+            answers = [self.values[k] for k in ks[start:end]]
+            decoded.append(answers if is_list else answers[0])
+            start = end
+
+        return decoded
+
+
+class Histogram(object):
+    """
+    How often each answer to a question was given by a set of rows.
+
+    `contained' counts the rows that selected an answer, `equal' the rows
+    whose answer was exactly the answer, and `total' the rows that gave a
+    non-empty answer.
+    """
+
+    def __init__(self, contained=None, equal=None, total=0):
+
+        self.contained = contained or {}
+        self.equal = equal or {}
+        self.total = total
+
+    @classmethod
+    def of(cls, column, rows):
+        """Return the histogram of the given rows of the given column."""
+
+        if column.multiple:
+            bits = np.unpackbits(column.bits[rows], axis=1,
+                                 bitorder="little")[:, :len(column.values)]
+            contained = bits.sum(axis=0)
+            equal = bits[~column.lists[rows]].sum(axis=0)
+        else:
+            contained = equal = np.bincount(column.codes[rows],
+                                            minlength=len(column.values))
+
+        equal = dict(zip(column.values, equal.tolist()))
+
+        return cls(dict(zip(column.values, contained.tolist())), equal,
+                   len(rows) - equal.get("", 0))
+
+    def update(self, other):
+        """Add the counts of the given histogram to ours."""
+
+        for answer, n in other.contained.items():
+            self.contained[answer] = self.contained.get(answer, 0) + n
+        for answer, n in other.equal.items():
+            self.equal[answer] = self.equal.get(answer, 0) + n
+        self.total += other.total
+
+    def contains(self, answer):
+
+        return self.contained.get(answer, 0) if isinstance(answer, str) else 0
+
+    def equals(self, answer):
+
+        return self.equal.get(answer, 0)
+
+
+class TableBuilder(object):
+    """
+    Encodes rows of answers one by one.  Every answer is a string, or a list
+    of strings for multiple-choice answers.
+    """
+
+    def __init__(self, record):
+
+        self.record = record
+        self.lookups = [{} for _ in record._fields]
+        self.codes = [array.array("L") for _ in record._fields]
+        self.lists = [{} for _ in record._fields]
+        self.size = 0
+
+    def __len__(self):
+
+        return self.size
+
+    def append(self, row):
+
+        if len(row) != len(self.lookups):
+            raise ValueError("Expected %d fields but got %d." %
+                             (len(self.lookups), len(row)))
+
+        # Lists are unhashable, which tells them apart from strings.
+
+        for lookup, codes, lists, value in zip(self.lookups, self.codes,
+                                                self.lists, row):
+            try:
+                codes.append(lookup.setdefault(value, len(lookup)))
+            except TypeError:
+                lists[self.size] = [lookup.setdefault(v, len(lookup))
+                                    for v in value]
+                codes.append(0)
+
+        self.size += 1
+
+    def table(self):
+        """Return the encoded rows as a Table."""
+
+        columns = []
+        for lookup, codes, lists in zip(self.lookups, self.codes, self.lists):
+            values = list(lookup)
+            codes = np.array(codes, dtype=code_type(len(values)))
+            if not lists:
+                columns.append(Column(values, codes=codes))
+                continue
+
+            # Turn the column into one bitmask per row.
+
+            is_list = np.zeros(self.size, dtype=bool)
+            is_list[list(lists)] = True
+            bits = np.zeros((self.size, (len(values) + 7) // 8 * 8),
+                            dtype=bool)
+            single = np.flatnonzero(~is_list)
+            bits[single, codes[single]] = True
+            for row, ks in lists.items():
+                bits[row, ks] = True
+
+            columns.append(Column(values,
+                                  bits=np.packbits(bits, axis=1,
+                                                   bitorder="little"),
+                                  lists=is_list))
+
+        return Table(self.record, columns)
+
+
+class Table(object):
+    """
+    All responses of a survey, one Column per field of the given namedtuple
+    type `record'.
+    """
+
+    def __init__(self, record, columns):
+
+        self.record = record
+        self.columns = dict(zip(record._fields, columns))
+        self.size = len(columns[0]) if columns else 0
+
+    @classmethod
+    def load(cls, file_name, record, key):
+        """
+        Return the Table saved in the given file, whose arrays are
+        memory-mapped, or None if the file does not exist or was not saved
+        with the given key and record type.
+        """
+
+        try:
+            with open(file_name, "rb") as fd:
+                if fd.readline() != SNAPSHOT_MAGIC:
+                    return None
+                header = json.loads(fd.readline().decode("utf-8"))
+        except (OSError, ValueError):
+            return None
+
+        if header["key"] != key or header["fields"] != list(record._fields):
+            return None
+
+        def array(spec):
+
+            offset, dtype, shape = spec
+            if not np.prod(shape):
+                return np.zeros(shape, dtype=dtype)
+            return np.memmap(file_name, dtype=dtype, mode="r",
+                             offset=offset, shape=tuple(shape))
+
+        columns = []
+        for column in header["columns"]:
+            columns.append(Column(column["values"],
+                                  **{name: array(spec) for name, spec in
+                                     column["arrays"].items()}))
+
+        return cls(record, columns)
+
+    def save(self, file_name, key):
+        """
+        Save the table to the given file, to be loaded with the given key.
+
+        The file starts with a line of JSON that describes every column and
+        the offsets of its arrays, which follow, aligned to
+        SNAPSHOT_ALIGNMENT bytes.  We write to a temporary file first, so
+        that readers never see a partial snapshot.
+        """
+
+        arrays = []
+        columns = []
+        for field in self.record._fields:
+            column = self.columns[field]
+            names = ["codes"] if not column.multiple else ["bits", "lists"]
+            columns.append({"values": column.values, "arrays": {}})
+            for name in names:
+                arrays.append((columns[-1]["arrays"], name,
+                               np.ascontiguousarray(getattr(column, name))))
+
+        # The header's length depends on the offsets, so we reserve enough
+        # space for offsets of any length.
+
+        def header(start):
+
+            offset = start
+            for specs, name, a in arrays:
+                offset = -(-offset // SNAPSHOT_ALIGNMENT) * SNAPSHOT_ALIGNMENT
+                specs[name] = [offset, a.dtype.str, list(a.shape)]
+                offset += a.nbytes
+            return (json.dumps({"key": key,
+                                "fields": list(self.record._fields),
+                                "columns": columns}) + "\n").encode("utf-8")
+
+        start = len(SNAPSHOT_MAGIC) + len(header(0)) + 20 * (len(arrays) + 1)
+        start = -(-start // SNAPSHOT_ALIGNMENT) * SNAPSHOT_ALIGNMENT
+        data = header(start)
+        data += b" " * (start - len(SNAPSHOT_MAGIC) - len(data))
+
+        temp_name = "%s.%d.tmp" % (file_name, os.getpid())
+        with open(temp_name, "wb") as fd:
+            fd.write(SNAPSHOT_MAGIC + data)
+            for specs, name, a in arrays:
+                fd.seek(specs[name][0])
+                fd.write(a.tobytes())
+        os.replace(temp_name, file_name)
+
+    @classmethod
+    def from_rows(cls, record, rows):
+
+        builder = TableBuilder(record)
+        for row in rows:
+            builder.append(row)
+
+        return builder.table()
+
+    def __len__(self):
+
+        return self.size
+
+    def response(self, row):
+        """Return the given row as a `record' tuple."""
+
+        return self.record(*[self.columns[f].value(row)
+                             for f in self.record._fields])
+
+    def responses(self, rows):
+        """Return the given rows as `record' tuples."""
+
+        return [self.record(*values) for values in
+                zip(*[self.columns[f].decode(rows)
+                      for f in self.record._fields])]
+
+
+def to_bitset(mask):
+    """Turn the given boolean array into an integer whose bit i is mask[i]."""
+
+    return int.from_bytes(np.packbits(mask, bitorder="little").tobytes(),
+                          "little")
+
+
+def from_bitset(bits, size):
+    """Return the positions of the set bits of the given integer, which has
+    at most `size' bits."""
+
+    data = np.frombuffer(bits.to_bytes((size + 7) // 8, "little"),
+                         dtype=np.uint8)
+
+    return np.flatnonzero(np.unpackbits(data, bitorder="little")[:size])
+
+
+class AnswerIndex(object):
+    """
+    An inverted index from (question, answer) to the set of the given rows
+    that selected the answer.
+
+    Sets are Python integers whose bit i stands for rows[i], so that
+    intersection, union, and complement are bitwise operations, and sizes
+    are popcounts.  The sets for questions with at most MAX_INDEXED_VALUES
+    distinct answers are built right away; all others when first needed.
+    """
+
+    MAX_INDEXED_VALUES = 32
+
+    def __init__(self, table, rows):
+
+        self.table = table
+        self.rows = rows
+        self.all = (1 << len(rows)) - 1
+        self.contained = {}
+        self.equal = {}
+
+        for question, column in table.columns.items():
+            if len(column.values) > self.MAX_INDEXED_VALUES:
+                continue
+            if column.multiple:
+                for k, answer in enumerate(column.values):
+                    self.contained[(question, answer)] = \
+                        to_bitset(column.has(k, rows))
+            else:
+                codes = column.codes[rows]
+                for k, answer in enumerate(column.values):
+                    self.contained[(question, answer)] = \
+                        to_bitset(codes == k)
+
+    def __len__(self):
+
+        return len(self.rows)
+
+    def contains(self, question, answer):
+        """Return the set of rows that selected the given answer."""
+
+        # Like Column.contains, no row selected an answer that is a list.
+
+        if not isinstance(answer, str):
+            return 0
+
+        key = (question, answer)
+        if key not in self.contained:
+            column = self.table.columns[question]
+            self.contained[key] = to_bitset(column.contains(answer,
+                                                            self.rows))
+
+        return self.contained[key]
+
+    def equals(self, question, answer):
+        """Return the set of rows that gave exactly the given answer."""
+
+        column = self.table.columns[question]
+        if isinstance(answer, str) and not column.multiple:
+            return self.contains(question, answer)
+
+        key = (question, tuple(answer) if isinstance(answer, list)
+               else answer)
+        if key not in self.equal:
+            self.equal[key] = to_bitset(column.equals(answer, self.rows))
+
+        return self.equal[key]
+
+    def positions(self, bits):
+        """Return the positions in `rows' of the given set."""
+
+        return from_bitset(bits, len(self.rows))
+
+    def bitset(self, rows):
+        """Return the set of the given rows, which must all be indexed."""
+
+        mask = np.zeros(len(self.rows), dtype=bool)
+        mask[np.searchsorted(self.rows, rows)] = True
+
+        return to_bitset(mask)
@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+#
+# Generate synthetic survey exports for benchmarks.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Writes UTF-16 TSV files that look like Qualtrics exports of the survey: three
+meta data lines followed by one line per respondent, with the fields of
+analyse_survey_data.Response.
+
+Answers are random, but follow the survey's structure.  Multiple-choice
+questions select every option with probability `density', text fields are
+mostly empty, and every respondent passes each attention check with
+probability ATTENTION, so that pruning has something to do.
+"""
+
+import sys
+import codecs
+import random
+import argparse
+import datetime
+
+from analyse_survey_data import Response, ATTENTION_CHECKS, METADATA_LINES
+
+# Multiple-choice questions and their number of options.
+
+MULTIPLE_CHOICE = {"q2_4": 9, "q2_5": 6, "q3_5": 6, "q3_6": 6, "q3_8": 9,
+                   "q3_15": 5, "q4_4": 6, "q5_6": 8, "q5_11": 7, "q6_2": 7}
+
+# The number of options of all other questions.
+
+SINGLE_CHOICE = 6
+
+# Fields that are always empty.
+
+EMPTY = ["ip_addr", "last_name", "first_name", "email", "ext_ref",
+         "bogus1", "bogus2", "bogus3", "bogus4"]
+
+DEFAULT_DENSITY = 0.25
+
+# Probabilities that a respondent finished the survey, passes an attention
+# check, leaves a question unanswered, and fills in a text field.
+
+FINISHED = 0.9
+ATTENTION = 0.8
+UNANSWERED = 0.05
+TEXT = 0.05
+
+START = datetime.datetime(2017, 9, 18)
+
+
+def multiple_choice(rng, options, density):
+    """Return a multiple-choice answer, e.g., "1,4,5", or "" if no option
+    was selected."""
+
+    return ",".join(str(k) for k in range(1, options + 1)
+                    if rng.random() < density)
+
+
+def attention_answer(rng, question, answer, density):
+    """Return a right or wrong answer to the given attention check."""
+
+    right = ",".join(answer) if isinstance(answer, list) else answer
+    if rng.random() < ATTENTION:
+        return right
+
+    while True:
+        if question in MULTIPLE_CHOICE:
+            wrong = multiple_choice(rng, MULTIPLE_CHOICE[question], density)
+        else:
+            wrong = str(rng.randint(1, SINGLE_CHOICE))
+        if wrong != right:
+            return wrong
+
+
+def response(rng, number, density):
+    """Return the fields of a random response."""
+
+    start = START + datetime.timedelta(minutes=number // 10)
+    duration = int(rng.expovariate(1 / 900.0)) + 60
+    end = start + datetime.timedelta(seconds=duration)
+    fields = {
+        "start_date": start.strftime("%Y-%m-%d %H:%M:%S"),
+        "end_date": end.strftime("%Y-%m-%d %H:%M:%S"),
+        "status": "0",
+        "progress": "100",
+        "duration": str(duration),
+        "finished": "1" if rng.random() < FINISHED else "0",
+        "recorded_date": end.strftime("%Y-%m-%d %H:%M:%S"),
+        "id": "R_%015d" % number,
+        "latitude": "%.4f" % rng.uniform(-90, 90),
+        "longitude": "%.4f" % rng.uniform(-180, 180),
+        "dist_channel": "anonymous",
+        "language": "EN",
+    }
+
+    for field in Response._fields:
+        if field in fields:
+            continue
+        if field in EMPTY:
+            fields[field] = ""
+        elif "_text" in field:
+            fields[field] = "some text" if rng.random() < TEXT else ""
+        elif rng.random() < UNANSWERED:
+            fields[field] = ""
+        elif field in MULTIPLE_CHOICE:
+            fields[field] = multiple_choice(rng, MULTIPLE_CHOICE[field],
+                                            density)
+        else:
+            fields[field] = str(rng.randint(1, SINGLE_CHOICE))
+
+    for question, answer in ATTENTION_CHECKS:
+        fields[question] = attention_answer(rng, question, answer, density)
+
+    return [fields[field] for field in Response._fields]
+
+
+def write_survey(file_name, respondents, density=DEFAULT_DENSITY, seed=None):
+    """Write a synthetic export with the given number of respondents."""
+
+    rng = random.Random(seed)
+    with codecs.open(file_name, "w", "utf-16") as fd:
+        for line in range(METADATA_LINES):
+            fd.write("\t".join("%s (%d)" % (field, line)
+                               for field in Response._fields) + "\n")
+        for number in range(respondents):
+            fd.write("\t".join(response(rng, number, density)) + "\n")
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Write a synthetic survey "
+                                     "export.")
+    parser.add_argument("file_name", metavar="FILE_NAME",
+                        help="UTF-16 TSV file to write.")
+    parser.add_argument("-n", "--respondents", type=int, default=1000,
+                        help="Number of respondents (default: %(default)d).")
+    parser.add_argument("-d", "--density", type=float,
+                        default=DEFAULT_DENSITY,
+                        help="Probability that a respondent selects an "
+                        "option of a multiple-choice question (default: "
+                        "%(default).2f).")
+    parser.add_argument("--seed", type=int,
+                        help="Seed for the random answers.")
+    args = parser.parse_args()
+
+    write_survey(args.file_name, args.respondents, args.density, args.seed)
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
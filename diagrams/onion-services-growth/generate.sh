@@ -1,5 +1,6 @@
 #!/bin/bash
 
-Rscript plot-os-growth.R os-growth.csv
+python3 os_growth.py os-growth.csv -o os-growth-plot.csv
+Rscript plot-os-growth.R os-growth-plot.csv
 pdfcrop os-growth.pdf
 cp os-growth-crop.pdf ../../paper/figures/os-growth.pdf
@@ -0,0 +1,326 @@
+#!/usr/bin/env python3
+#
+# Prepare the onion service growth series in os-growth.csv, which holds daily
+# Tor Metrics estimates of several types, e.g., dir-onions-seen and
+# rend-relayed-cells, for plot-os-growth.R.
+#
+# The series is loaded into one float array per type, with one row per day
+# from the first to the last date and one column per field, and NaN for days
+# without an estimate.  From these, we compute rolling means and medians,
+# growth rates, and weekly or monthly aggregates with vectorised window and
+# group operations.
+#
+# The output has the columns of os-growth.csv and only holds the selected
+# types, so the plot script only reads the rows that it plots.  With
+# --resample, every week or month becomes a single row, dated by its first
+# day.  With --rolling, values are replaced by their rolling mean or median
+# over the given number of rows, and with --growth, a "growth" column holds
+# the relative change of wmedian from the previous row.
+
+import sys
+import argparse
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+FIELDS = ["wmean", "wmedian", "wiqm", "frac", "stats"]
+
+# Fields that are aggregated over time.  "stats" is the number of relays
+# that reported statistics, which we sum.
+
+VALUE_FIELDS = ["wmean", "wmedian", "wiqm", "frac"]
+
+PERIODS = ["day", "week", "month"]
+AGGREGATES = ["mean", "median", "last"]
+
+DEFAULT_TYPES = ["dir-onions-seen"]
+
+
+class GrowthSeries(object):
+    """
+    Daily estimates of several types, pivoted by type: `dates' holds every
+    day from the first to the last estimate, and `values' maps every type to
+    a float array with a row per date and a column per field in FIELDS.
+    """
+
+    def __init__(self, dates, values):
+
+        self.dates = dates
+        self.values = values
+
+    @classmethod
+    def load(cls, file_name):
+
+        with open(file_name, "r") as fd:
+            header = fd.readline().strip().split(",")
+            rows = [line.strip().split(",") for line in fd if line.strip()]
+
+        if not rows:
+            return cls(np.array([], dtype="datetime64[D]"), {})
+
+        columns = list(zip(*rows))
+        dates = np.array(columns[header.index("date")], dtype="datetime64[D]")
+        types = np.array(columns[header.index("type")])
+        fields = np.column_stack([np.array(columns[header.index(field)],
+                                           dtype=float)
+                                  for field in FIELDS])
+
+        # Every estimate goes into the row of its day.
+
+        first = dates.min()
+        days = (dates - first).astype(int)
+        all_dates = first + np.arange(days.max() + 1)
+        values = {}
+        for type in np.unique(types):
+            selected = types == type
+            values[str(type)] = np.full((len(all_dates), len(FIELDS)),
+                                        np.nan)
+            values[str(type)][days[selected]] = fields[selected]
+
+        return cls(all_dates, values)
+
+    def field(self, type, field):
+        """Return the column of the given type and field."""
+
+        return self.values[type][:, FIELDS.index(field)]
+
+
+def rolling(values, window, how="mean", min_periods=None):
+    """
+    Return the rolling mean or median of the given array over the last
+    `window' rows, ignoring NaN.  Rows with fewer than `min_periods' values
+    in their window, which defaults to the window size, are NaN.
+    """
+
+    min_periods = window if min_periods is None else min_periods
+    values = np.asarray(values, dtype=float)
+    result = np.full(values.shape, np.nan)
+    if len(values) < window:
+        return result
+
+    windows = sliding_window_view(values, window, axis=0)
+    counts = (~np.isnan(windows)).sum(axis=-1)
+    with np.errstate(invalid="ignore"):
+        if how == "mean":
+            sums = np.where(np.isnan(windows), 0.0, windows).sum(axis=-1)
+            aggregate = sums / counts
+        elif how == "median":
+            aggregate = median_of_sorted(np.sort(windows, axis=-1), counts)
+        else:
+            raise ValueError("Unknown aggregate `%s'." % how)
+
+    result[window - 1:] = np.where(counts >= max(min_periods, 1), aggregate,
+                                   np.nan)
+
+    return result
+
+
+def median_of_sorted(values, counts):
+    """Return the medians of the given arrays, sorted along their last axis
+    with NaN last, and holding `counts' values that are not NaN."""
+
+    low = np.take_along_axis(values, np.expand_dims(np.maximum(counts - 1, 0)
+                                                    // 2, -1), -1)[..., 0]
+    high = np.take_along_axis(values, np.expand_dims(counts // 2, -1)
+                              .clip(max=values.shape[-1] - 1), -1)[..., 0]
+
+    return np.where(counts > 0, (low + high) / 2, np.nan)
+
+
+def growth(values, periods=1):
+    """Return the relative change of every row from the row `periods' rows
+    earlier, e.g., 0.1 for 10% growth."""
+
+    values = np.asarray(values, dtype=float)
+    result = np.full(values.shape, np.nan)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        result[periods:] = values[periods:] / values[:-periods] - 1
+
+    return result
+
+
+def period_starts(dates, period):
+    """Return the first day of the week (starting on Monday) or month of
+    every date."""
+
+    if period == "day":
+        return dates
+    if period == "week":
+        # 1970-01-01 was a Thursday.
+
+        days = dates.astype("datetime64[D]").astype(np.int64)
+        return dates - ((days + 3) % 7).astype("timedelta64[D]")
+    if period == "month":
+        return dates.astype("datetime64[M]").astype("datetime64[D]")
+
+    raise ValueError("Unknown period `%s'." % period)
+
+
+def resample(dates, values, period, how="mean"):
+    """
+    Aggregate the rows of the given array by week or month, ignoring NaN,
+    and return the first day of every period and the aggregated rows.  Besides
+    AGGREGATES, `how' can be "sum".  With "last", every period gets its last
+    value that is not NaN.
+    """
+
+    starts, groups = np.unique(period_starts(dates, period),
+                               return_inverse=True)
+    values = np.asarray(values, dtype=float)
+    if values.ndim == 1:
+        return starts, resample(dates, values[:, np.newaxis], period,
+                                how)[1][:, 0]
+
+    valid = ~np.isnan(values)
+    counts = np.zeros((len(starts), values.shape[1]), dtype=int)
+    np.add.at(counts, groups, valid)
+
+    if how in ("mean", "sum"):
+        sums = np.zeros(counts.shape)
+        np.add.at(sums, groups, np.where(valid, values, 0.0))
+        if how == "sum":
+            return starts, np.where(counts > 0, sums, np.nan)
+        with np.errstate(invalid="ignore"):
+            return starts, np.where(counts > 0, sums / counts, np.nan)
+
+    # Sort every column by group, and by value or date within groups, so
+    # that every group is a contiguous block with NaN at its end.
+
+    offsets = np.searchsorted(groups[np.argsort(groups, kind="stable")],
+                              np.arange(len(starts)))
+    result = np.full(counts.shape, np.nan)
+    for column in range(values.shape[1]):
+        if how == "median":
+            order = np.lexsort((values[:, column], groups))
+            block = values[order, column]
+            low = offsets + np.maximum(counts[:, column] - 1, 0) // 2
+            high = offsets + counts[:, column] // 2
+            high = np.minimum(high, len(block) - 1)
+            median = (block[low] + block[high]) / 2
+            result[:, column] = np.where(counts[:, column] > 0, median,
+                                         np.nan)
+        elif how == "last":
+            order = np.lexsort((np.arange(len(groups)), ~valid[:, column],
+                                groups))
+            block = values[order, column]
+            last = offsets + np.maximum(counts[:, column] - 1, 0)
+            result[:, column] = np.where(counts[:, column] > 0, block[last],
+                                         np.nan)
+        else:
+            raise ValueError("Unknown aggregate `%s'." % how)
+
+    return starts, result
+
+
+def aggregate(series, type, period="day", how="mean", window=0,
+              rolling_how="mean"):
+    """
+    Return the dates and the FIELDS of the given type, aggregated by period
+    and smoothed with a rolling window of `window' rows, if any.  Days
+    without an estimate before the first and after the last estimate of the
+    type are dropped.
+    """
+
+    values = series.values[type]
+    estimated = np.flatnonzero(~np.isnan(values).all(axis=1))
+    values = values[estimated[0]:estimated[-1] + 1].copy()
+    dates = series.dates[estimated[0]:estimated[-1] + 1]
+
+    if period != "day":
+        stats = FIELDS.index("stats")
+        columns = [FIELDS.index(field) for field in VALUE_FIELDS]
+        _, summed = resample(dates, values[:, stats], period, "sum")
+        dates, aggregated = resample(dates, values[:, columns], period, how)
+        values = np.full((len(dates), len(FIELDS)), np.nan)
+        values[:, columns] = aggregated
+        values[:, stats] = summed
+
+    if window > 1:
+        for field in VALUE_FIELDS:
+            column = FIELDS.index(field)
+            values[:, column] = rolling(values[:, column], window,
+                                        rolling_how)
+
+    return dates, values
+
+
+def format_number(x):
+
+    if np.isnan(x):
+        return "NA"
+
+    return "%.12g" % x
+
+
+def write_series(fd, rows, with_growth=False):
+    """Write (date, type, values) rows as CSV in the format of
+    os-growth.csv, optionally with a growth column."""
+
+    header = ["date", "type"] + FIELDS + (["growth"] if with_growth else [])
+    fd.write(",".join(header) + "\n")
+    for date, type, values in rows:
+        fd.write(",".join([str(date), type] +
+                          [format_number(x) for x in values]) + "\n")
+
+
+def parse_args(argv):
+
+    parser = argparse.ArgumentParser(description="Prepare the onion service "
+                                     "growth series for plotting.")
+    parser.add_argument("file_name", metavar="FILE",
+                        help="CSV file with the series, e.g., "
+                        "os-growth.csv.")
+    parser.add_argument("-o", "--output",
+                        help="CSV file to write to (default: stdout).")
+    parser.add_argument("-t", "--type", action="append",
+                        help="Type to include; may be given several times "
+                        "(default: %s)." % ", ".join(DEFAULT_TYPES))
+    parser.add_argument("-r", "--resample", choices=PERIODS, default="day",
+                        help="Aggregate rows by day, week, or month "
+                        "(default: %(default)s).")
+    parser.add_argument("-a", "--aggregate", choices=AGGREGATES,
+                        default="mean",
+                        help="How to aggregate values by week or month "
+                        "(default: %(default)s).")
+    parser.add_argument("-w", "--rolling", type=int, default=0,
+                        metavar="ROWS",
+                        help="Smooth values over this many rows.")
+    parser.add_argument("--rolling-aggregate", choices=AGGREGATES[:2],
+                        default="mean",
+                        help="How to smooth values (default: "
+                        "%(default)s).")
+    parser.add_argument("-g", "--growth", action="store_true",
+                        help="Add the relative change of wmedian.")
+
+    return parser.parse_args(argv)
+
+
+def main(argv):
+
+    args = parse_args(argv)
+    series = GrowthSeries.load(args.file_name)
+
+    rows = []
+    for type in args.type or DEFAULT_TYPES:
+        if type not in series.values:
+            print("Type `%s' is not in `%s'." % (type, args.file_name),
+                  file=sys.stderr)
+            return 1
+
+        dates, values = aggregate(series, type, args.resample,
+                                  args.aggregate, args.rolling,
+                                  args.rolling_aggregate)
+        if args.growth:
+            changes = growth(values[:, FIELDS.index("wmedian")])
+            values = np.column_stack([values, changes])
+        rows.extend(zip(dates, [type] * len(dates), values))
+
+    fd = open(args.output, "w") if args.output else sys.stdout
+    write_series(fd, rows, args.growth)
+    if fd is not sys.stdout:
+        fd.close()
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -1,27 +1,492 @@
+#!/usr/bin/env python3
+#
+# Find pairs of similar onion domains in a CSV file whose first column holds
+# the domain, e.g., onion_leak_frequency.csv.  Every pair whose Jaro-Winkler
+# similarity exceeds the threshold is written to the output file as
+# "name1,name2,similarity".  Use --backend numpy to compare names in
+# vectorised blocks.
+#
+# --metric selects the Jaro, Jaro-Winkler, or Levenshtein similarity, each
+# with an optional threshold, e.g., "--metric jaro=0.9 --metric levenshtein".
+# All selected metrics are computed in a single pass.  A pair is reported if
+# it exceeds the threshold of any metric, in a CSV file with one column per
+# metric, or with --split, in one file per metric, e.g., vals.jaro.csv.
+#
+# Resolvers that use DNS 0x20 randomise the case of queried names, so a leak
+# list holds many case variants of the same domain.  With --fold-case, names
+# are grouped by their lower-case form and only distinct lower-case names are
+# compared.  Groups with several variants are written to a separate file,
+# e.g., vals.variants.csv, as "canonical,variant,count".
+#
+# The upper triangle of all pairs is split into row blocks ("shards") of
+# roughly equal work, which can run on a process pool.  Matches are appended
+# to the output file as each shard finishes, and completed shards are recorded
+# in a progress file next to the output so that an interrupted run can be
+# resumed with --resume.
+#
+# The names of a completed run are recorded in an index next to the output.
+# With --update, only names that are not in the index are compared against
+# the indexed names and each other, and new pairs are appended to the output.
+# An interrupted update that is run again without --resume first drops the
+# names and pairs it added (see check_similarity_update.py).
+
+import os
+import re
 import sys
-from Levenshtein import jaro_winkler
-
-f = open(sys.argv[1], 'r')
-names = []
-for line in f:
-    names.append(line.split(",")[0])
-f.close()
-
-count = 0
-pairs = []
-all_pairs = []
-for n in names:
-    print "Completed: " + str(count)
-    for n2 in names:
-        x = jaro_winkler(n, n2)
-        if x > .90 and n != n2 and ((n,n2) not in pairs) and ((n2,n) not in pairs):
-            pairs.append((n,n2))
-    count += 1
-
-print len(all_pairs)
-
-f = open(sys.argv[2], 'w')
-for p in pairs:
-    f.write(p[0] + "," + p[1] + "," + str(jaro_winkler(p[0], p[1])) + "\n")
-f.close()
+import hashlib
+import argparse
+import multiprocessing
+
+from similarity import AllPairs, METRICS, DEFAULT_METRIC, DEFAULT_THRESHOLD
+from similarity_index import SimilarityIndex
+
+BACKENDS = ["python", "numpy"]
+
+
+def log(*args, **kwargs):
+    """Generic log function that prints to stderr."""
+
+    print("[+]", *args, file=sys.stderr, **kwargs)
+
+
+def read_counts(file_name):
+    """
+    Return a mapping from the unique names in the first column of the given
+    file to the sum of their counts in the second column, in the order in
+    which names first appear.  Lines without a count count once.
+    """
+
+    counts = {}
+    with open(file_name, "r") as fd:
+        for line in fd:
+            fields = line.split(",")
+            name = fields[0].strip()
+            if not name:
+                continue
+            try:
+                count = int(fields[1])
+            except (IndexError, ValueError):
+                count = 1
+            counts[name] = counts.get(name, 0) + count
+
+    return counts
+
+
+def fold_case(counts):
+    """
+    Group the given names by their lower-case form.  Return a mapping from
+    lower-case names to lists of (variant, count) tuples.
+    """
+
+    groups = {}
+    for name, count in counts.items():
+        groups.setdefault(name.lower(), []).append((name, count))
+
+    return groups
+
+
+def write_variants(file_name, groups):
+    """Write the groups with more than one case variant to the given file,
+    and return how many there are."""
+
+    variants = 0
+    with open(file_name, "w") as fd:
+        for canonical, group in groups.items():
+            if len(group) < 2:
+                continue
+            variants += 1
+            for name, count in group:
+                fd.write("%s,%s,%d\n" % (canonical, name, count))
+
+    return variants
+
+
+def format_similarity(x):
+    """Format the given similarity like Python 2's str(float) did."""
+
+    s = "%.12g" % x
+    if "." not in s and "e" not in s:
+        s += ".0"
+
+    return s
+
+
+def format_pair(n1, n2, values):
+    """Format a pair of similar names as a line of an output file."""
+
+    return "%s,%s,%s\n" % (n1, n2, ",".join(format_similarity(x)
+                                             for x in values))
+
+
+def output_files(output, metrics, split):
+    """Return a list of output file names and the metrics each one reports."""
+
+    if not split or len(metrics) == 1:
+        return [(output, metrics)]
+
+    root, ext = os.path.splitext(output)
+
+    return [("%s.%s%s" % (root, m, ext), [m]) for m in metrics]
+
+
+def triangle_shards(n, shards, first=0):
+    """
+    Split the rows of the upper triangle of an n x n matrix into at most the
+    given number of (start, end) row blocks that hold about as many pairs.
+    Only pairs whose column is at least `first' count.
+    """
+
+    work = [n - max(i + 1, first) for i in range(n)]
+    per_shard = max(1, sum(work) // max(1, shards))
+
+    blocks = []
+    start = pairs = 0
+    for i in range(n):
+        pairs += work[i]
+        if pairs >= per_shard or i == n - 1:
+            blocks.append((start, i + 1))
+            start, pairs = i + 1, 0
+
+    return blocks
+
+
+def make_engine(names, thresholds, backend, first=0):
+    """Return the all-pairs engine for the given metrics and backend."""
+
+    if backend == "numpy":
+        from jaro_numpy import NumpyAllPairs
+        return NumpyAllPairs(names, thresholds, first=first)
+
+    return AllPairs(names, thresholds, first=first)
+
+
+# Every worker process builds its own engine once, in init_worker.  `_columns'
+# holds the positions of every output file's metrics in the engine's values.
+
+_engine = None
+_columns = None
+
+
+def init_worker(engine_args, metrics):
+
+    global _engine, _columns
+    _engine = make_engine(*engine_args)
+    _columns = [[_engine.metrics.index(m) for m in ms] for ms in metrics]
+
+
+def run_shard(shard):
+    """
+    Return the shard number and, for every output file, the formatted pairs
+    of the given shard that exceed a threshold of the file's metrics.
+    """
+
+    number, (start, end) = shard
+    names, metrics = _engine.names, _engine.metrics
+    thresholds = _engine.thresholds
+
+    lines = [[] for _ in _columns]
+    for i, j, values in _engine.matches(range(start, end)):
+        for out, columns in zip(lines, _columns):
+            selected = [values[c] for c in columns]
+            if any(values[c] > thresholds[metrics[c]] for c in columns):
+                out.append(format_pair(names[i], names[j], selected))
+
+    return number, lines
+
+
+class Progress(object):
+    """
+    Records completed shards and the output file sizes after each of them.
+
+    The first line of the progress file describes the run, so that we never
+    resume a run with different input or parameters.  Every further line
+    holds a shard's number and the sizes of the `outputs' output files.
+    """
+
+    def __init__(self, file_name, header, outputs):
+
+        self.file_name = file_name
+        self.header = header
+        self.outputs = outputs
+        self.done = set()
+        self.offsets = []
+        self.end = 0
+
+    def parse(self, line):
+        """Return the fields of the given record, or None if it is torn."""
+
+        fields = line.split()
+        if not line.endswith("\n") or len(fields) != 1 + self.outputs:
+            return None
+        try:
+            return [int(x) for x in fields]
+        except ValueError:
+            return None
+
+    def load(self):
+        """Load a previous run's progress and return True if it matches."""
+
+        if not os.path.exists(self.file_name):
+            return False
+
+        with open(self.file_name, "r") as fd:
+            header = fd.readline()
+            if header.strip() != self.header:
+                return False
+            self.end = len(header)
+            for line in fd:
+                fields = self.parse(line)
+                if fields is None:
+                    break
+                self.done.add(fields[0])
+                self.offsets = fields[1:]
+                self.end += len(line)
+
+        # Without the record of where the run's output starts, we cannot
+        # truncate it.
+
+        return -1 in self.done
+
+    def interrupted(self):
+        """
+        Return the number of indexed names and the output sizes with which
+        the run in the progress file started, or None if there is none.  The
+        file only exists while a run is in progress or after it was stopped.
+        """
+
+        if not os.path.exists(self.file_name):
+            return None
+
+        with open(self.file_name, "r") as fd:
+            match = re.match(r"names=\d+ old=(\d+) ", fd.readline())
+            fields = self.parse(fd.readline())
+        if match is None or fields is None or fields[0] != -1:
+            return None
+
+        return int(match.group(1)), fields[1:]
+
+    def open(self, resume, offsets):
+        """Open the progress file, starting a new one unless we resume.  A
+        new run records where its output starts as shard -1."""
+
+        # Drop a record that was still being written when we were stopped,
+        # so that the next one does not continue it.
+
+        if resume:
+            os.truncate(self.file_name, self.end)
+        self.fd = open(self.file_name, "a" if resume else "w")
+        if not resume:
+            self.fd.write(self.header + "\n")
+            self.record(-1, offsets)
+
+    def record(self, number, offsets):
+        """Mark the given shard as done once the outputs reached the given
+        sizes."""
+
+        self.done.add(number)
+        self.offsets = offsets
+        self.fd.write("%d %s\n" % (number, " ".join(str(x) for x in offsets)))
+        self.fd.flush()
+        os.fsync(self.fd.fileno())
+
+    def close(self):
+
+        self.fd.close()
+        os.remove(self.file_name)
+
+
+def parse_metric(spec):
+    """Parse a metric given as NAME or NAME=THRESHOLD."""
+
+    name, _, threshold = spec.partition("=")
+    if name not in METRICS:
+        raise argparse.ArgumentTypeError("unknown metric '%s'" % name)
+    try:
+        return name, float(threshold) if threshold else None
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid threshold '%s'" % threshold)
+
+
+def parse_args(argv):
+
+    parser = argparse.ArgumentParser(description="Find similar onion "
+                                     "domains using string similarity.")
+    parser.add_argument("input", help="CSV file with one domain per line.")
+    parser.add_argument("output", help="CSV file to write similar pairs to.")
+    parser.add_argument("-t", "--threshold", type=float,
+                        default=DEFAULT_THRESHOLD,
+                        help="Default threshold of all metrics "
+                        "(default: %(default).2f).")
+    parser.add_argument("-m", "--metric", type=parse_metric, action="append",
+                        metavar="NAME[=THRESHOLD]",
+                        help="Similarity metric, one of %s; may be repeated "
+                        "(default: %s)." % (", ".join(METRICS),
+                                            DEFAULT_METRIC))
+    parser.add_argument("--split", action="store_true",
+                        help="Write one output file per metric instead of "
+                        "one column per metric.")
+    parser.add_argument("-f", "--fold-case", action="store_true",
+                        help="Only compare distinct lower-case names, and "
+                        "report case variants separately.")
+    parser.add_argument("-b", "--backend", choices=BACKENDS,
+                        default="python",
+                        help="Use pure Python or vectorised NumPy code "
+                        "(default: %(default)s).")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="Number of worker processes (default: 1).")
+    parser.add_argument("-s", "--shards", type=int, default=100,
+                        help="Number of row blocks to split the work into "
+                        "(default: %(default)d).")
+    parser.add_argument("-r", "--resume", action="store_true",
+                        help="Resume an interrupted run, skipping the shards "
+                        "it already completed.")
+    parser.add_argument("-u", "--update", action="store_true",
+                        help="Only compare names that are not yet in the "
+                        "output's index, and append their pairs.")
+
+    return parser.parse_args(argv)
+
+
+def main(argv):
+
+    args = parse_args(argv)
+
+    thresholds = {}
+    for name, threshold in args.metric or [(DEFAULT_METRIC, None)]:
+        thresholds[name] = args.threshold if threshold is None else threshold
+    metrics = list(thresholds)
+    outputs = output_files(args.output, metrics, args.split)
+    describe = "metrics=%s outputs=%d fold-case=%s" % (
+        ",".join("%s=%r" % (m, t) for m, t in thresholds.items()),
+        len(outputs), "yes" if args.fold_case else "no")
+
+    counts = read_counts(args.input)
+    log("Read %d unique names from '%s'." % (len(counts), args.input))
+
+    if args.fold_case:
+        groups = fold_case(counts)
+        root, ext = os.path.splitext(args.output)
+        variants = write_variants(root + ".variants" + ext, groups)
+        log("Folded names into %d lower-case names, %d of which have case "
+            "variants." % (len(groups), variants))
+        names = list(groups)
+    else:
+        names = list(counts)
+
+    index = SimilarityIndex(args.output + ".names", describe)
+    progress = Progress(args.output + ".progress", None, len(outputs))
+
+    # When updating, append the new names to the indexed ones and only
+    # consider pairs whose second name is new.  An update that was stopped
+    # may have appended pairs, and even names, already.  Unless we resume
+    # it, we start over from the index and output sizes it started with.
+
+    start = progress.interrupted() if args.update else None
+    if args.update:
+        if not index.exists():
+            log("No index '%s'; run without --update first." %
+                index.file_name)
+            return 1
+        missing = [name for name, _ in outputs if not os.path.exists(name)]
+        if missing:
+            log("No output '%s'; run without --update first." % missing[0])
+            return 1
+        try:
+            old = index.load()
+        except ValueError as err:
+            log(err)
+            return 1
+        if start is not None and len(old) > start[0]:
+            log("Dropping %d names of an interrupted update from the index." %
+                (len(old) - start[0]))
+            old = old[:start[0]]
+            index.truncate(len(old))
+        known = set(old)
+        new = [n for n in names if n not in known]
+        log("%d of %d names are not in the index." % (len(new), len(names)))
+        if not new:
+            if start is not None:
+                log("Dropping the pairs of an interrupted update.")
+                for (name, _), offset in zip(outputs, start[1]):
+                    os.truncate(name, min(offset, os.path.getsize(name)))
+                os.remove(progress.file_name)
+            return 0
+        names = old + new
+    else:
+        old, new = [], names
+    shards = triangle_shards(len(names), args.shards, len(old))
+
+    # The digest tells runs over the same number of names apart.
+
+    digest = hashlib.sha256("\n".join(names).encode("utf-8")).hexdigest()
+    progress.header = "names=%d old=%d digest=%s %s shards=%d" % (
+        len(names), len(old), digest, describe, len(shards))
+
+    missing = [name for name, _ in outputs if not os.path.exists(name)]
+    resume = args.resume and not missing and progress.load()
+    if args.resume and missing:
+        log("No output '%s'; starting from scratch." % missing[0])
+    elif args.resume and not resume:
+        log("No matching progress file; starting from scratch.")
+    if not resume and not args.update:
+        index.remove()
+
+    # Drop output of shards that were still being written when the previous
+    # run was interrupted.  Files with several metrics get a header.
+
+    fds = [open(name, "r+" if resume or args.update else "w")
+           for name, _ in outputs]
+    if not resume:
+        progress.offsets = [fd.seek(0, os.SEEK_END) for fd in fds]
+        if start is not None:
+            log("Dropping the pairs of an interrupted update.")
+            progress.offsets = [min(offset, end) for offset, end in
+                                zip(start[1], progress.offsets)]
+    for fd, offset, (_, ms) in zip(fds, progress.offsets, outputs):
+        fd.truncate(offset)
+        fd.seek(offset)
+        if not offset and len(ms) > 1:
+            fd.write("name1,name2,%s\n" % ",".join(ms))
+    progress.open(resume, [fd.tell() for fd in fds])
+
+    todo = [(k, shard) for k, shard in enumerate(shards)
+            if k not in progress.done]
+    log("Processing %d of %d shards using %d processes." %
+        (len(todo), len(shards), args.jobs))
+
+    worker_args = ((names, thresholds, args.backend, len(old)),
+                   [ms for _, ms in outputs])
+    if args.jobs > 1:
+        pool = multiprocessing.Pool(args.jobs, init_worker, worker_args)
+        results = pool.imap_unordered(run_shard, todo)
+    else:
+        init_worker(*worker_args)
+        results = map(run_shard, todo)
+
+    pairs = [0] * len(outputs)
+    for number, lines in results:
+        for k, (fd, out) in enumerate(zip(fds, lines)):
+            fd.writelines(out)
+            fd.flush()
+            os.fsync(fd.fileno())
+            pairs[k] += len(out)
+        progress.record(number, [fd.tell() for fd in fds])
+        log("Completed %d of %d shards." % (len(progress.done) - 1,
+                                            len(shards)))
+
+    if args.jobs > 1:
+        pool.close()
+        pool.join()
+    for fd in fds:
+        fd.close()
+    index.append(new)
+    progress.close()
+
+    for count, (name, _) in zip(pairs, outputs):
+        log("Wrote %d new pairs to '%s'." % (count, name))
+
+    return 0
+
 
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
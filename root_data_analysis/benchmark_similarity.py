@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+#
+# Time the stages of apply_similarity.py on synthetic lists of onion domains
+# (see synthetic_onions.py): reading the list, folding case variants, and
+# finding all similar pairs with every backend.  Lists are written to
+# --data-dir once and reused across runs.
+#
+# Every stage and size becomes one JSON line, e.g.,
+#
+#   {"benchmark": "similarity", "stage": "pairs:python", "size": 1000,
+#    "variants": 0.05, "near": 0.05, "seed": 1, "runs": 3, "wall": 0.41,
+#    "cpu": 0.40, "pairs": 52}
+#
+# where "wall" and "cpu" are the wall-clock and CPU seconds of the fastest
+# run.  Lines are appended to the output file, so that runs of several
+# versions can be compared.  Comparing all pairs is quadratic in the worst
+# case, so large sizes may need --stage to skip it.
+
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+
+from apply_similarity import log, read_counts, fold_case, make_engine, \
+    BACKENDS
+from similarity import DEFAULT_METRIC, DEFAULT_THRESHOLD
+from synthetic_onions import onion_names, DEFAULT_VARIANTS, DEFAULT_NEAR
+
+DEFAULT_SIZES = [1000, 10000, 100000, 1000000]
+DEFAULT_SEED = 1
+
+STAGES = ["read_counts", "fold_case"] + \
+    ["pairs:%s" % backend for backend in BACKENDS]
+
+
+def measure(function, runs=1):
+    """Call the given function the given number of times, and return the
+    wall-clock and CPU seconds of the fastest call, and its result."""
+
+    best = None
+    for _ in range(runs):
+        wall, cpu = time.perf_counter(), time.process_time()
+        result = function()
+        wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+        if best is None or wall < best[0]:
+            best = (wall, cpu)
+
+    return best[0], best[1], result
+
+
+def names_file(data_dir, size, variants, near, seed):
+    """Return the name of a synthetic list with the given parameters, writing
+    it if it does not exist yet."""
+
+    file_name = os.path.join(data_dir, "onions-%d-%g-%g-%d.csv" %
+                             (size, variants, near, seed))
+    if not os.path.exists(file_name):
+        log("Writing %d synthetic names to '%s'." % (size, file_name))
+        with open(file_name + ".tmp", "w") as fd:
+            for name, count in onion_names(size, variants, near, seed):
+                fd.write("%s,%d\n" % (name, count))
+        os.replace(file_name + ".tmp", file_name)
+
+    return file_name
+
+
+def benchmark(file_name, stages, runs, thresholds):
+    """Yield (stage, wall-clock seconds, CPU seconds, extra fields) for the
+    given stages on the given list."""
+
+    wall, cpu, counts = measure(lambda: read_counts(file_name),
+                                runs if "read_counts" in stages else 1)
+    if "read_counts" in stages:
+        yield "read_counts", wall, cpu, {}
+
+    if "fold_case" in stages:
+        wall, cpu, groups = measure(lambda: fold_case(counts), runs)
+        yield "fold_case", wall, cpu, {"names": len(groups)}
+
+    names = list(counts)
+    for backend in BACKENDS:
+        stage = "pairs:%s" % backend
+        if stage not in stages:
+            continue
+        wall, cpu, pairs = measure(lambda: sum(1 for _ in make_engine(
+            names, thresholds, backend).matches()), runs)
+        yield stage, wall, cpu, {"pairs": pairs}
+
+
+def parse_args(argv):
+
+    parser = argparse.ArgumentParser(description="Time the stages of "
+                                     "apply_similarity.py on synthetic "
+                                     "names.")
+    parser.add_argument("-n", "--sizes", type=int, nargs="+",
+                        default=DEFAULT_SIZES,
+                        help="Numbers of names (default: %s)." %
+                        " ".join(str(n) for n in DEFAULT_SIZES))
+    parser.add_argument("-c", "--variants", type=float,
+                        default=DEFAULT_VARIANTS,
+                        help="Fraction of names that are case variants "
+                        "(default: %(default).2f).")
+    parser.add_argument("-d", "--near", type=float, default=DEFAULT_NEAR,
+                        help="Fraction of names that are near-duplicates "
+                        "(default: %(default).2f).")
+    parser.add_argument("-t", "--threshold", type=float,
+                        default=DEFAULT_THRESHOLD,
+                        help="Threshold of the %s similarity (default: "
+                        "%%(default).2f)." % DEFAULT_METRIC)
+    parser.add_argument("--seed", type=int, default=DEFAULT_SEED,
+                        help="Seed for the synthetic names (default: "
+                        "%(default)d).")
+    parser.add_argument("-r", "--runs", type=int, default=3,
+                        help="Number of runs per stage, of which we report "
+                        "the fastest (default: %(default)d).")
+    parser.add_argument("-s", "--stage", action="append", choices=STAGES,
+                        help="Stage to time; may be given several times "
+                        "(default: all).")
+    parser.add_argument("--data-dir", default=tempfile.gettempdir(),
+                        help="Directory for the synthetic lists (default: "
+                        "%(default)s).")
+    parser.add_argument("-o", "--output",
+                        help="File to append JSON lines to (default: "
+                        "stdout).")
+
+    return parser.parse_args(argv)
+
+
+def main(argv):
+
+    args = parse_args(argv)
+
+    stages = args.stage or STAGES
+    thresholds = {DEFAULT_METRIC: args.threshold}
+    fd = open(args.output, "a") if args.output else sys.stdout
+    for size in args.sizes:
+        file_name = names_file(args.data_dir, size, args.variants, args.near,
+                               args.seed)
+        for stage, wall, cpu, extra in benchmark(file_name, stages,
+                                                 args.runs, thresholds):
+            log("%s on %d names: %.3fs." % (stage, size, wall))
+            result = {"benchmark": "similarity", "stage": stage,
+                      "size": size, "variants": args.variants,
+                      "near": args.near, "seed": args.seed,
+                      "runs": args.runs, "wall": wall, "cpu": cpu}
+            result.update(extra)
+            fd.write(json.dumps(result) + "\n")
+            fd.flush()
+    if fd is not sys.stdout:
+        fd.close()
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+#
+# Check that apply_similarity.py recovers from an --update that was killed
+# partway.  We index the first names of a synthetic list (see
+# synthetic_onions.py), start an update with the whole list, kill it with
+# SIGKILL once it completed a few shards, rerun it, and compare the output
+# with that of a run over the whole list.  The output must hold every pair
+# exactly once.
+#
+# Every scenario reruns the update differently:
+#
+#   rerun:   without --resume, which starts the update over.
+#   resume:  with --resume, which skips the completed shards.
+#   indexed: without --resume, after the killed update got to add its names
+#            to the index, as if it was killed right before it finished.
+#
+# Exits with 1 if any scenario fails.
+
+import os
+import sys
+import time
+import signal
+import argparse
+import tempfile
+import subprocess
+
+from apply_similarity import log
+from synthetic_onions import onion_names
+
+SCENARIOS = ["rerun", "resume", "indexed"]
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                      "apply_similarity.py")
+
+
+def run(*args):
+
+    subprocess.run([sys.executable, SCRIPT] + list(args), check=True,
+                   stderr=subprocess.DEVNULL)
+
+
+def kill_after(shards, *args):
+    """Run apply_similarity.py with the given arguments, and kill it once it
+    recorded the given number of shards.  Return False if it finished
+    first."""
+
+    progress = args[1] + ".progress"
+    process = subprocess.Popen([sys.executable, SCRIPT] + list(args),
+                               stderr=subprocess.DEVNULL)
+    while process.poll() is None:
+        if os.path.exists(progress):
+            with open(progress, "r") as fd:
+                if len(fd.readlines()) >= shards + 2:
+                    process.send_signal(signal.SIGKILL)
+                    process.wait()
+                    return True
+        time.sleep(0.01)
+
+    return False
+
+
+def read_lines(file_name):
+
+    with open(file_name, "r") as fd:
+        return fd.readlines()
+
+
+def check(directory, scenario, names, indexed, shards, killed):
+    """Run the given scenario in the given directory, and return True if the
+    output is right."""
+
+    def path(name):
+
+        return os.path.join(directory, "%s-%s" % (scenario, name))
+
+    first, full, output = path("first.csv"), path("full.csv"), path("out.csv")
+    for file_name, count in ((first, indexed), (full, len(names))):
+        with open(file_name, "w") as fd:
+            for name, n in names[:count]:
+                fd.write("%s,%d\n" % (name, n))
+
+    expected = path("expected.csv")
+    run(full, expected, "-s", str(shards))
+    run(first, output, "-s", str(shards))
+    if not kill_after(killed, full, output, "-u", "-s", str(shards)):
+        log("%s: the update finished before we could kill it." % scenario)
+        return False
+
+    if scenario == "indexed":
+        with open(output + ".names", "a") as fd:
+            for name, _ in names[indexed:]:
+                fd.write(name + "\n")
+    run(full, output, "-u", "-s", str(shards),
+        *(["-r"] if scenario == "resume" else []))
+
+    lines = read_lines(output)
+    if len(lines) != len(set(lines)):
+        log("%s: %d of %d pairs are duplicates." %
+            (scenario, len(lines) - len(set(lines)), len(lines)))
+        return False
+    if sorted(lines) != sorted(read_lines(expected)):
+        log("%s: the pairs differ from those of a run over all names." %
+            scenario)
+        return False
+    if len(read_lines(output + ".names")) != len(names) + 1:
+        log("%s: the index does not hold every name once." % scenario)
+        return False
+
+    log("%s: %d pairs, as expected." % (scenario, len(lines)))
+
+    return True
+
+
+def parse_args(argv):
+
+    parser = argparse.ArgumentParser(description="Check that "
+                                     "apply_similarity.py recovers from an "
+                                     "interrupted --update.")
+    parser.add_argument("-n", "--names", type=int, default=6000,
+                        help="Number of names (default: %(default)d).")
+    parser.add_argument("-i", "--indexed", type=int, default=3000,
+                        help="Number of names to index before the update "
+                        "(default: %(default)d).")
+    parser.add_argument("-s", "--shards", type=int, default=50,
+                        help="Number of shards (default: %(default)d).")
+    parser.add_argument("-k", "--killed", type=int, default=5,
+                        help="Number of shards after which we kill the "
+                        "update (default: %(default)d).")
+    parser.add_argument("--seed", type=int, default=1,
+                        help="Seed for the synthetic names (default: "
+                        "%(default)d).")
+    parser.add_argument("--scenario", action="append", choices=SCENARIOS,
+                        help="Scenario to check; may be given several times "
+                        "(default: all).")
+
+    return parser.parse_args(argv)
+
+
+def main(argv):
+
+    args = parse_args(argv)
+
+    names = onion_names(args.names, seed=args.seed)
+    with tempfile.TemporaryDirectory() as directory:
+        results = [check(directory, scenario, names, args.indexed,
+                         args.shards, args.killed)
+                   for scenario in args.scenario or SCENARIOS]
+
+    return 0 if all(results) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+#
+# Count how often every onion domain leaked, e.g., to build
+# onion_leak_frequency.csv from the output of ../code/analyse-pcap, or
+# straight from pcap files (see dns_pcap).  Leak records are read from the
+# given files or stdin, and the counts are written as "name,count" lines,
+# sorted by ascending count.
+#
+# Month-long resolver captures can hold more distinct names than fit in
+# memory.  Counts are exact up to --max-names distinct names.  Beyond that,
+# we only keep --max-names counters and report approximate counts of the most
+# frequent names, each with an upper bound on its overestimation (see
+# leaks.LeakCounter).
+
+import sys
+import argparse
+
+from leaks import read_records, LeakCounter
+from apply_similarity import log
+
+DEFAULT_MAX_NAMES = 1000000
+
+
+def parse_args(argv):
+
+    parser = argparse.ArgumentParser(description="Count leaked onion "
+                                     "domains.")
+    parser.add_argument("files", nargs="*", metavar="FILE",
+                        help="Files with leak records, or pcap files; \"-\" "
+                        "or none means stdin.")
+    parser.add_argument("-o", "--output",
+                        help="CSV file to write counts to (default: stdout).")
+    parser.add_argument("-m", "--max-names", type=int,
+                        default=DEFAULT_MAX_NAMES,
+                        help="Number of distinct names to count exactly "
+                        "(default: %(default)d).")
+    parser.add_argument("-n", "--top", type=int, default=0,
+                        help="Only write the N most frequent names (default: "
+                        "all).")
+    parser.add_argument("-e", "--errors", action="store_true",
+                        help="Add a third column with the largest possible "
+                        "overestimation of every count.")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="Number of pcap files to read in parallel "
+                        "(default: %(default)d).")
+
+    args = parser.parse_args(argv)
+    if args.max_names < 1:
+        parser.error("--max-names must be positive")
+
+    return args
+
+
+def main(argv):
+
+    args = parse_args(argv)
+
+    counter = LeakCounter(args.max_names)
+    try:
+        for _, name in read_records(args.files, args.jobs):
+            counter.add(name)
+    except ValueError as err:
+        log(err)
+        return 1
+
+    log("Counted %d leaks of %d names." % (counter.total,
+                                           len(counter.counts)))
+    if not counter.exact:
+        log("More than %d distinct names leaked.  Counts are approximate and "
+            "overestimate by at most %d; every name that leaked more than %d "
+            "times is included." % (args.max_names, counter.max_error(),
+                                    counter.total // args.max_names))
+
+    items = counter.top(args.top) if args.top else counter.items()
+    fd = open(args.output, "w") if args.output else sys.stdout
+    for name, count, error in items:
+        if args.errors:
+            fd.write("%s,%d,%d\n" % (name, count, error))
+        else:
+            fd.write("%s,%d\n" % (name, count))
+    if fd is not sys.stdout:
+        fd.close()
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
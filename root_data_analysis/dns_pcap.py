@@ -0,0 +1,388 @@
+"""
+Extracting onion domains from DNS queries in pcap files.
+
+This replaces ../code/analyse-pcap, which expected every packet to carry its
+DNS message 42 bytes into the frame, i.e., behind an Ethernet header, an IPv4
+header without options, and a UDP header.  Here, we walk the link-layer, IP,
+and UDP headers of every packet, so that captures with VLAN tags, IP options,
+or IPv6 work as well.
+
+Capture files are memory-mapped, and headers are read in place with
+struct.unpack_from, so that a packet's bytes are only copied for the names of
+onion domains that we report.  Of the DNS message, only the header and the
+question section are parsed.
+"""
+
+import mmap
+import time
+import struct
+import collections
+import multiprocessing
+
+# The time format of leak records, which is analyse-pcap's TIME_LAYOUT.
+
+TIME_FORMAT = "%Y-%m-%d.%H:%M:%S"
+
+# Magic numbers of pcap files, with microsecond and nanosecond timestamps,
+# which tell the byte order of the file.  We only need the seconds.
+
+PCAP_MAGIC = {b"\xd4\xc3\xb2\xa1": "<",
+              b"\xa1\xb2\xc3\xd4": ">",
+              b"\x4d\x3c\xb2\xa1": "<",
+              b"\xa1\xb2\x3c\x4d": ">"}
+PCAPNG_MAGIC = b"\x0a\x0d\x0d\x0a"
+FILE_HEADER_SIZE = 24
+RECORD_HEADER_SIZE = 16
+
+# Link-layer types that we can parse.
+
+LINKTYPE_NULL = 0
+LINKTYPE_ETHERNET = 1
+LINKTYPE_RAW = 101
+LINKTYPE_LINUX_SLL = 113
+LINKTYPE_LINUX_SLL2 = 276
+
+ETHERTYPE_IPV4 = 0x0800
+ETHERTYPE_IPV6 = 0x86dd
+ETHERTYPE_VLAN = (0x8100, 0x88a8, 0x9100)
+
+IPPROTO_UDP = 17
+
+# IPv6 extension headers that may precede the UDP header.
+
+IPV6_HOP_BY_HOP = 0
+IPV6_ROUTING = 43
+IPV6_FRAGMENT = 44
+IPV6_AUTH = 51
+IPV6_DEST_OPTS = 60
+
+UDP_HEADER_SIZE = 8
+DNS_HEADER_SIZE = 12
+# Bounds the compression pointers that we follow in a single name.
+
+MAX_POINTERS = 16
+
+# With several jobs, every file is read by a process that hands its records
+# to us in chunks of CHUNK_RECORDS records, through a queue that holds at
+# most QUEUE_CHUNKS chunks.
+
+CHUNK_RECORDS = 10000
+QUEUE_CHUNKS = 8
+
+
+def is_pcap(file_name):
+    """Return True if the given file is a pcap or pcapng file.  We cannot
+    read the latter, but onion_queries says so."""
+
+    with open(file_name, "rb") as fd:
+        magic = fd.read(4)
+
+    return magic in PCAP_MAGIC or magic == PCAPNG_MAGIC
+
+
+def link_payload(data, offset, end, link_type):
+    """
+    Return the offset of the IP header in the frame that spans data[offset:
+    end], and its IP version, or (None, None) if the frame does not carry
+    IPv4 or IPv6.
+    """
+
+    if link_type == LINKTYPE_ETHERNET:
+        if end - offset < 14:
+            return None, None
+        ether_type, = struct.unpack_from("!H", data, offset + 12)
+        offset += 14
+        while ether_type in ETHERTYPE_VLAN and end - offset >= 4:
+            ether_type, = struct.unpack_from("!H", data, offset + 2)
+            offset += 4
+    elif link_type == LINKTYPE_RAW:
+        if end <= offset:
+            return None, None
+        version = data[offset] >> 4
+        return (offset, version) if version in (4, 6) else (None, None)
+    elif link_type == LINKTYPE_LINUX_SLL:
+        if end - offset < 16:
+            return None, None
+        ether_type, = struct.unpack_from("!H", data, offset + 14)
+        offset += 16
+    elif link_type == LINKTYPE_LINUX_SLL2:
+        if end - offset < 20:
+            return None, None
+        ether_type, = struct.unpack_from("!H", data, offset)
+        offset += 20
+    elif link_type == LINKTYPE_NULL:
+        if end - offset < 4:
+            return None, None
+        version = data[offset + 4] >> 4 if end - offset > 4 else None
+        return (offset + 4, version) if version in (4, 6) else (None, None)
+    else:
+        return None, None
+
+    if ether_type == ETHERTYPE_IPV4:
+        return offset, 4
+    if ether_type == ETHERTYPE_IPV6:
+        return offset, 6
+
+    return None, None
+
+
+def udp_payload(data, offset, end, version):
+    """
+    Return the offset of the UDP payload in the IP packet at data[offset:
+    end], or None if the packet is not UDP or is a fragment other than the
+    first one.
+    """
+
+    if version == 4:
+        if end - offset < 20:
+            return None
+        header_size = (data[offset] & 0x0f) * 4
+        flags_fragment, = struct.unpack_from("!H", data, offset + 6)
+        if header_size < 20 or flags_fragment & 0x1fff or \
+                data[offset + 9] != IPPROTO_UDP:
+            return None
+        offset += header_size
+    else:
+        if end - offset < 40:
+            return None
+        next_header = data[offset + 6]
+        offset += 40
+        while next_header != IPPROTO_UDP:
+            if end - offset < 8:
+                return None
+            if next_header == IPV6_FRAGMENT:
+                fragment, = struct.unpack_from("!H", data, offset + 2)
+                if fragment & 0xfff8:
+                    return None
+                size = 8
+            elif next_header == IPV6_AUTH:
+                size = (data[offset + 1] + 2) * 4
+            elif next_header in (IPV6_HOP_BY_HOP, IPV6_ROUTING,
+                                 IPV6_DEST_OPTS):
+                size = (data[offset + 1] + 1) * 8
+            else:
+                return None
+            next_header = data[offset]
+            offset += size
+
+    offset += UDP_HEADER_SIZE
+
+    return offset if offset <= end else None
+
+
+def question_labels(data, offset, start, end):
+    """
+    Return the (offset, length) of every label of the name at data[offset:
+    end], and the offset behind the name, or None if the name is malformed.
+    Compression pointers are relative to the DNS message at `start'.
+    """
+
+    labels = []
+    behind = None
+    pointers = 0
+    while True:
+        if offset >= end:
+            return None
+        length = data[offset]
+        if length == 0:
+            break
+        if length & 0xc0 == 0xc0:
+            if offset + 1 >= end or pointers == MAX_POINTERS:
+                return None
+            if behind is None:
+                behind = offset + 2
+            pointers += 1
+            offset = start + (((length & 0x3f) << 8) | data[offset + 1])
+            continue
+        if length & 0xc0 or offset + 1 + length > end:
+            return None
+        labels.append((offset + 1, length))
+        offset += 1 + length
+
+    return labels, offset + 1 if behind is None else behind
+
+
+def format_label(label):
+    """Turn a label into text, escaping like miekg/dns, which analyse-pcap
+    used to print names."""
+
+    chars = []
+    for byte in label:
+        if byte in b".\\\"();@$ ":
+            chars.append("\\" + chr(byte))
+        elif byte < 0x21 or byte > 0x7e:
+            chars.append("\\%03d" % byte)
+        else:
+            chars.append(chr(byte))
+
+    return "".join(chars)
+
+
+def onion_questions(data, offset, end, responses=False):
+    """
+    Yield the names of all onion domains in the question section of the DNS
+    message at data[offset:end], as fully qualified names.  Responses are
+    ignored unless `responses' is set.
+    """
+
+    if end - offset < DNS_HEADER_SIZE:
+        return
+    flags, questions = struct.unpack_from("!HH", data, offset + 2)
+    if flags & 0x8000 and not responses:
+        return
+
+    position = offset + DNS_HEADER_SIZE
+    for _ in range(questions):
+        parsed = question_labels(data, position, offset, end)
+        if parsed is None:
+            return
+        labels, position = parsed
+        position += 4
+
+        # Like analyse-pcap, we check the last label, but ignore its case,
+        # because resolvers that use DNS 0x20 randomise it.
+
+        if len(labels) < 2 or labels[-1][1] != 5:
+            continue
+        last, length = labels[-1]
+        if bytes(data[last:last + length]).lower() != b"onion":
+            continue
+
+        yield "".join(format_label(data[label:label + length]) + "."
+                      for label, length in labels)
+
+
+def onion_queries(file_name, responses=False):
+    """
+    Yield (time, name) for every onion domain that was queried in the given
+    pcap file, in the format of leak records.  Times are UTC.
+    """
+
+    with open(file_name, "rb") as fd:
+        try:
+            data = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # Empty files cannot be mapped.
+
+            return
+
+    try:
+        magic = data[:4]
+        if magic == PCAPNG_MAGIC:
+            raise ValueError("`%s' is a pcapng file; convert it with "
+                             "\"editcap -F pcap\"." % file_name)
+        if magic not in PCAP_MAGIC or len(data) < FILE_HEADER_SIZE:
+            raise ValueError("`%s' is not a pcap file." % file_name)
+
+        byte_order = PCAP_MAGIC[magic]
+        record_header = struct.Struct(byte_order + "IIII")
+        link_type, = struct.unpack_from(byte_order + "I", data, 20)
+        link_type &= 0xffff
+
+        last_second = None
+        last_time = None
+        offset = FILE_HEADER_SIZE
+        size = len(data)
+        while offset + RECORD_HEADER_SIZE <= size:
+            second, _, captured, _ = record_header.unpack_from(data, offset)
+            offset += RECORD_HEADER_SIZE
+            end = min(offset + captured, size)
+            packet, offset = offset, offset + captured
+
+            ip, version = link_payload(data, packet, end, link_type)
+            if ip is None:
+                continue
+            dns = udp_payload(data, ip, end, version)
+            if dns is None:
+                continue
+
+            for name in onion_questions(data, dns, end, responses):
+                if second != last_second:
+                    last_second = second
+                    last_time = time.strftime(TIME_FORMAT,
+                                              time.gmtime(second))
+                yield last_time, name
+    finally:
+        data.close()
+
+
+def queue_onion_queries(file_name, responses, queue):
+    """Put the onion queries in the given file into the given queue in
+    chunks, followed by None, or by the exception that stopped us."""
+
+    try:
+        chunk = []
+        for record in onion_queries(file_name, responses):
+            chunk.append(record)
+            if len(chunk) == CHUNK_RECORDS:
+                queue.put(chunk)
+                chunk = []
+        if chunk:
+            queue.put(chunk)
+        queue.put(None)
+    except Exception as err:
+        queue.put(err)
+
+
+def read_queue(queue, done):
+    """Yield the records of a file from the given queue, and mark the file
+    as done once it ended."""
+
+    while True:
+        chunk = queue.get()
+        if chunk is None:
+            done.append(True)
+            return
+        if isinstance(chunk, Exception):
+            raise chunk
+        yield from chunk
+
+
+def read_pcaps(file_names, jobs=1, responses=False):
+    """
+    Yield an iterable of (time, name) for every onion domain that was queried
+    in each of the given pcap files, in the order of the files.
+
+    With several jobs, up to `jobs' files are read in parallel.  Processes
+    that get ahead of us block once their queue is full, so that memory holds
+    at most jobs * QUEUE_CHUNKS * CHUNK_RECORDS records.
+    """
+
+    if jobs <= 1 or len(file_names) <= 1:
+        for file_name in file_names:
+            yield onion_queries(file_name, responses)
+        return
+
+    pending = iter(file_names)
+    running = collections.deque()
+
+    def start():
+
+        for file_name in pending:
+            queue = multiprocessing.Queue(QUEUE_CHUNKS)
+            process = multiprocessing.Process(
+                target=queue_onion_queries, args=(file_name, responses,
+                                                  queue), daemon=True)
+            process.start()
+            running.append((process, queue))
+            return
+
+    try:
+        for _ in range(jobs):
+            start()
+        while running:
+            process, queue = running.popleft()
+            done = []
+            yield read_queue(queue, done)
+
+            # A file that was not read to its end leaves its process blocked
+            # on the full queue.
+
+            if done:
+                process.join()
+            else:
+                process.terminate()
+            start()
+    finally:
+        for process, _ in running:
+            process.terminate()
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+#
+# Extract queries for onion domains from pcap files of DNS traffic, like
+# ../code/analyse-pcap, and write them as leak records: "time,name" lines,
+# e.g., "2017-09-18.20:06:54,xxlvbrloxvriy2c5.onion.", with times in UTC.
+# Capture files are read in parallel with --jobs, and records are written in
+# the order of the files.
+#
+# count_leaks.py and leak_series.py also read pcap files directly, so this is
+# only needed to keep the records around.
+
+import sys
+import argparse
+
+from dns_pcap import read_pcaps
+from apply_similarity import log
+
+
+def parse_args(argv):
+
+    parser = argparse.ArgumentParser(description="Extract onion domains "
+                                     "from DNS queries in pcap files.")
+    parser.add_argument("files", nargs="+", metavar="FILE",
+                        help="Pcap files to analyse.")
+    parser.add_argument("-o", "--output",
+                        help="File to write leak records to (default: "
+                        "stdout).")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="Number of files to read in parallel (default: "
+                        "%(default)d).")
+    parser.add_argument("-r", "--responses", action="store_true",
+                        help="Also extract names from the question section "
+                        "of DNS responses.")
+
+    return parser.parse_args(argv)
+
+
+def main(argv):
+
+    args = parse_args(argv)
+
+    fd = open(args.output, "w") if args.output else sys.stdout
+    leaks = 0
+    try:
+        for file_name, records in zip(args.files,
+                                      read_pcaps(args.files, args.jobs,
+                                                 args.responses)):
+            count = 0
+            for time, name in records:
+                fd.write("%s,%s\n" % (time, name))
+                count += 1
+            log("Found %d onion queries in `%s'." % (count, file_name))
+            leaks += count
+    except ValueError as err:
+        log(err)
+        return 1
+    finally:
+        if fd is not sys.stdout:
+            fd.close()
+
+    log("Found %d onion queries in %d files." % (leaks, len(args.files)))
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,343 @@
+"""
+Vectorised Jaro, Jaro-Winkler, and Levenshtein similarity using NumPy.
+
+Names of equal length are encoded as rows of an integer matrix, which lets us
+compare one name (or a batch of names) against a whole block of names at
+once, without calling a Python function per pair.  Onion domains are
+fixed-width (16 or 56 base32 characters plus ".onion."), so a leak list
+usually consists of one or two such matrices.  The results are identical to
+the pure Python functions in similarity.py.
+"""
+
+import numpy as np
+
+from similarity import AllPairs, DEFAULT_METRIC, DEFAULT_THRESHOLD, \
+    DEFAULT_PREFIX_WEIGHT, PREFIX_GROUP, tokenize
+
+DEFAULT_BATCH_SIZE = 256
+DEFAULT_BLOCK_SIZE = 8192
+
+
+def encode(names):
+    """Encode the given names of equal length as a matrix of code points."""
+
+    length = len(names[0]) if names else 0
+    codes = np.frombuffer("".join(names).encode("utf-32-le"),
+                          dtype=np.uint32).reshape(len(names), length)
+    if codes.size and codes.max() < 256:
+        codes = codes.astype(np.uint8)
+
+    return codes
+
+
+def prefix_pairs(s_a, s_b):
+    """Return the common prefix lengths of the rows of two matrices."""
+
+    m = min(s_a.shape[1], s_b.shape[1])
+    equal = s_a[:, :m] == s_b[:, :m]
+
+    return np.where(equal.all(axis=1), m, equal.argmin(axis=1))
+
+
+def jaro_pairs(s_a, s_b):
+    """Return the Jaro similarities of the rows of two matrices."""
+
+    k, len_a, len_b = len(s_a), s_a.shape[1], s_b.shape[1]
+    if not len_a or not len_b:
+        return np.full(k, 1.0 if len_a == len_b else 0.0)
+
+    # Make s1 always the shorter (or equally long) string.
+
+    s1, s2 = (s_a, s_b) if len_a <= len_b else (s_b, s_a)
+    len1, len2 = s1.shape[1], s2.shape[1]
+
+    # Assign every character of s2 to the earliest unassigned, equal character
+    # of s1 within the match window, one column at a time for all rows.
+
+    halflen = (len1 + 1) // 2
+    rows = np.arange(k)
+    assigned = np.zeros((k, len1), dtype=bool)
+    order = np.zeros((k, len1), dtype=np.int64)
+    match = np.zeros(k, dtype=np.int64)
+    for i in range(min(len1 + halflen, len2)):
+        lo, hi = max(0, i - halflen), min(len1, i + halflen + 1)
+        equal = (s1[:, lo:hi] == s2[:, i, None]) & ~assigned[:, lo:hi]
+        found = equal.any(axis=1)
+        r, j = rows[found], lo + equal.argmax(axis=1)[found]
+        match[r] += 1
+        order[r, j] = match[r]
+        assigned[r, j] = True
+
+    # Count transpositions, i.e., common characters that were assigned out of
+    # order.
+
+    rank = np.cumsum(assigned, axis=1)
+    trans = (assigned & (order != rank)).sum(axis=1)
+
+    md = match.astype(np.float64)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        j = (md / len1 + md / len2 + 1.0 - trans / md / 2.0) / 3.0
+
+    return np.where(match > 0, j, 0.0)
+
+
+def winkler_block(jaro_values, prefix, prefix_weight=DEFAULT_PREFIX_WEIGHT):
+    """Apply the Winkler prefix bonus to an array of Jaro similarities."""
+
+    j = jaro_values + (1.0 - jaro_values) * prefix * prefix_weight
+
+    return np.minimum(j, 1.0)
+
+
+def jaro_block(a, block):
+    """Return the Jaro similarity of `a' and every row of `block'."""
+
+    return jaro_pairs(np.broadcast_to(a, (len(block), len(a))), block)
+
+
+def jaro_winkler_block(a, block, prefix_weight=DEFAULT_PREFIX_WEIGHT):
+    """Return the Jaro-Winkler similarity of `a' and every row of `block'."""
+
+    s_a = np.broadcast_to(a, (len(block), len(a)))
+
+    return winkler_block(jaro_pairs(s_a, block), prefix_pairs(s_a, block),
+                         prefix_weight)
+
+
+def levenshtein_pairs(s_a, s_b):
+    """Return the Levenshtein distances of the rows of two matrices."""
+
+    k, len_a, len_b = len(s_a), s_a.shape[1], s_b.shape[1]
+    steps = np.arange(len_b + 1)
+    previous = np.tile(steps, (k, 1))
+
+    # Within a row of the dynamic programming matrix, cell j is the minimum
+    # over t <= j of best[t] + (j - t), which is a cumulative minimum.
+
+    for i in range(1, len_a + 1):
+        best = np.empty_like(previous)
+        best[:, 0] = i
+        best[:, 1:] = np.minimum(previous[:, :-1] + (s_a[:, i - 1, None] !=
+                                                     s_b),
+                                 previous[:, 1:] + 1)
+        previous = np.minimum.accumulate(best - steps, axis=1) + steps
+
+    return previous[:, -1]
+
+
+def levenshtein_similarity_pairs(s_a, s_b):
+    """Return the Levenshtein similarities of the rows of two matrices."""
+
+    longest = max(s_a.shape[1], s_b.shape[1])
+    if not longest:
+        return np.ones(len(s_a))
+
+    return 1.0 - levenshtein_pairs(s_a, s_b).astype(np.float64) / longest
+
+
+def jaro_bound_block(len1, len2, overlap):
+    """Return upper bounds of the Jaro similarity given character overlaps."""
+
+    md = np.minimum(overlap, min(len1, len2)).astype(np.float64)
+    j = (md / len1 + md / len2 + 1.0 - 0.0) / 3.0
+
+    return np.where(md > 0, j, 0.0)
+
+
+def levenshtein_bound_block(len1, len2, overlap):
+    """Return upper bounds of the Levenshtein similarity given character
+    overlaps."""
+
+    longest = max(len1, len2)
+    md = np.minimum(overlap, min(len1, len2))
+
+    return 1.0 - (longest - md).astype(np.float64) / longest
+
+
+class NumpyAllPairs(AllPairs):
+    """
+    A drop-in replacement for AllPairs that compares a batch of names against
+    blocks of names at once.
+
+    The character multiset overlap of all pairs in a batch and a block is a
+    single matrix product of token indicator matrices (see
+    similarity.tokenize).  Pairs whose overlap is too small and whose first
+    PREFIX_GROUP characters differ are discarded.  The remaining pairs must
+    pass the bounds with their exact prefix before we compute their exact
+    similarities, grouped by the lengths of both names.
+    """
+
+    def __init__(self, names, thresholds=None,
+                 prefix_weight=DEFAULT_PREFIX_WEIGHT,
+                 first=0, batch_size=DEFAULT_BATCH_SIZE,
+                 block_size=DEFAULT_BLOCK_SIZE):
+
+        self.names = names
+        self.thresholds = thresholds or {DEFAULT_METRIC: DEFAULT_THRESHOLD}
+        self.metrics = list(self.thresholds)
+        self.prefix_weight = prefix_weight
+        self.first = first
+        self.batch_size = batch_size
+        self.block_size = block_size
+        self.needed = {}
+
+        # Encode names bucketed by length, and remember where every name
+        # ended up.
+
+        by_length = {}
+        for i, n in enumerate(names):
+            by_length.setdefault(len(n), []).append(i)
+
+        self.codes = {}
+        self.where = np.zeros(len(names), dtype=np.int64)
+        for length, ids in by_length.items():
+            self.codes[length] = encode([names[i] for i in ids])
+            self.where[ids] = np.arange(len(ids))
+
+        self.lengths = np.array([len(n) for n in names], dtype=np.int64)
+
+        # Number the distinct prefixes of PREFIX_GROUP characters, which only
+        # matter for Jaro-Winkler.
+
+        prefixes = {}
+        grouped = "jaro-winkler" in self.thresholds
+        self.keys = np.array([prefixes.setdefault(n[:PREFIX_GROUP],
+                                                  len(prefixes))
+                              if len(n) >= PREFIX_GROUP and grouped else -1
+                              for n in names], dtype=np.int64)
+
+        # Count every name's characters over the alphabet of all names.  A
+        # token (c, k) is present in a name if it has more than k c's.
+
+        alphabet = sorted(set("".join(names)))
+        symbols = dict((c, k) for k, c in enumerate(alphabet))
+        self.counts = np.zeros((len(names), len(alphabet)), dtype=np.int32)
+        for i, n in enumerate(names):
+            for c in n:
+                self.counts[i, symbols[c]] += 1
+
+        tokens = sorted(set(t for n in names for t in tokenize(n)))
+        self.token_symbols = np.array([symbols[c] for c, _ in tokens],
+                                      dtype=np.int64)
+        self.token_levels = np.array([k for _, k in tokens], dtype=np.int32)
+
+        # Minimum overlap for pairs with a short prefix, indexed by both
+        # names' positions in `distinct'.
+
+        distinct = np.unique(self.lengths)
+        self.length_index = np.searchsorted(distinct, self.lengths)
+        self.need = np.array([[self.min_overlap(l1, l2) for l2 in distinct]
+                              for l1 in distinct], dtype=np.float32)
+
+    def indicators(self, ids):
+        """Return the token indicator matrix of the given names."""
+
+        return (self.counts[ids][:, self.token_symbols] >
+                self.token_levels).astype(np.float32)
+
+    def encoded(self, ids):
+        """Return the encoded names with the given indices, which must all
+        have the same length."""
+
+        return self.codes[self.lengths[ids[0]]][self.where[ids]]
+
+    def exceeds_block(self, values):
+        """Return which of the given per-metric arrays exceed a threshold."""
+
+        return np.logical_or.reduce([x > self.thresholds[m]
+                                     for m, x in zip(self.metrics, values)])
+
+    def verify(self, first, second):
+        """
+        Return the similarities of the given pairs of names as a matrix with
+        one column per metric, and which of the pairs exceed a threshold.
+        All first names must have the same length, and so must all second
+        names.
+        """
+
+        s_a, s_b = self.encoded(first), self.encoded(second)
+        len1, len2 = s_a.shape[1], s_b.shape[1]
+        prefix = prefix_pairs(s_a, s_b)
+        overlap = self.overlap(first, second)
+
+        j = jaro_bound_block(len1, len2, overlap)
+        bound = {"jaro": j,
+                 "jaro-winkler": winkler_block(j, prefix, self.prefix_weight),
+                 "levenshtein": levenshtein_bound_block(len1, len2, overlap)}
+        keep = self.exceeds_block([bound[m] for m in self.metrics])
+
+        values = np.zeros((len(first), len(self.metrics)))
+        if not keep.any():
+            return values, keep
+
+        s_a, s_b = s_a[keep], s_b[keep]
+        exact = {}
+        if "jaro" in self.thresholds or "jaro-winkler" in self.thresholds:
+            exact["jaro"] = jaro_pairs(s_a, s_b)
+            exact["jaro-winkler"] = winkler_block(exact["jaro"], prefix[keep],
+                                                  self.prefix_weight)
+        if "levenshtein" in self.thresholds:
+            exact["levenshtein"] = levenshtein_similarity_pairs(s_a, s_b)
+        values[keep] = np.column_stack([exact[m] for m in self.metrics])
+
+        return values, keep & self.exceeds_block(values.T)
+
+    def overlap(self, first, second):
+        """Return the character multiset overlap of the given pairs."""
+
+        return np.minimum(self.counts[first], self.counts[second]).sum(axis=1)
+
+    def batch(self, rows):
+        """Return (i, j, similarities) for all pairs that exceed a threshold
+        and whose first name is one of the given sorted rows."""
+
+        first, second = [], []
+        u_rows = self.indicators(rows)
+        start = max(rows[0] + 1, self.first)
+        for lo in range(start, len(self.names), self.block_size):
+            cols = np.arange(lo, min(lo + self.block_size, len(self.names)))
+            overlap = u_rows @ self.indicators(cols).T
+            need = self.need[self.length_index[rows][:, None],
+                             self.length_index[cols][None, :]]
+            keys = self.keys[rows][:, None]
+            candidate = ((overlap >= need) |
+                         ((keys == self.keys[cols][None, :]) & (keys >= 0)))
+            candidate &= cols[None, :] > rows[:, None]
+            r, c = np.nonzero(candidate)
+            first.append(rows[r])
+            second.append(cols[c])
+
+        if not first:
+            return []
+        first, second = np.concatenate(first), np.concatenate(second)
+
+        # Compute exact similarities, grouped by the lengths of both names.
+
+        found = []
+        groups = self.lengths[first] * (self.lengths.max() + 1) + \
+            self.lengths[second]
+        for group in np.unique(groups):
+            pairs = np.flatnonzero(groups == group)
+            values, above = self.verify(first[pairs], second[pairs])
+            found.extend(zip(first[pairs][above].tolist(),
+                             second[pairs][above].tolist(),
+                             values[above].tolist()))
+
+        return sorted(found)
+
+    def row(self, i):
+        """Yield (j, similarities) for all partners j > i that exceed a
+        threshold."""
+
+        for _, j, values in self.batch(np.array([i])):
+            yield j, values
+
+    def matches(self, rows=None):
+        """Yield (i, j, similarities) for all pairs i < j that exceed a
+        threshold."""
+
+        rows = np.arange(len(self.names)) if rows is None else \
+            np.array(sorted(rows), dtype=np.int64)
+        for lo in range(0, len(rows), self.batch_size):
+            for match in self.batch(rows[lo:lo + self.batch_size]):
+                yield match
@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+#
+# Count leaked onion domains over time, to find bursts such as malware
+# beaconing.  Leak records are read from the given files or stdin, in a
+# single pass, and counted in windows of a minute, an hour, or a day.  By
+# default, windows do not overlap; with --slide, a new window starts every
+# minute or hour, e.g., hour-long windows every minute.
+#
+# Totals are written as "window,start,total" lines and, with --per-name,
+# counts of every name as "window,start,name,count" lines.  "start" is the
+# window's start in the time format of leak records (UTC), and "window" its
+# length, followed by the slide for sliding windows, e.g., "hour/minute".
+#
+# Records are expected in time order.  A window is written once we saw a
+# leak after its end, so memory holds only the names of the current windows.
+# Records that are more than --lateness seconds older than the latest record
+# may fall into windows that were already written, and are dropped.
+
+import sys
+import argparse
+
+from leaks import read_records, format_time, TimeParser, LeakSeries, \
+    RESOLUTIONS
+from apply_similarity import log
+
+
+def parse_args(argv):
+
+    parser = argparse.ArgumentParser(description="Count leaked onion "
+                                     "domains over time.")
+    parser.add_argument("files", nargs="*", metavar="FILE",
+                        help="Files with leak records, or pcap files; \"-\" "
+                        "or none means stdin.")
+    parser.add_argument("-w", "--window", action="append",
+                        choices=list(RESOLUTIONS),
+                        help="Window length; may be given several times "
+                        "(default: hour).")
+    parser.add_argument("-s", "--slide", choices=list(RESOLUTIONS),
+                        help="Start a window every minute, hour, or day "
+                        "(default: when the previous window ends).")
+    parser.add_argument("-l", "--lateness", type=int, default=0,
+                        help="Seconds that records may be out of order "
+                        "(default: %(default)d).")
+    parser.add_argument("-o", "--output",
+                        help="CSV file to write totals to (default: "
+                        "stdout).")
+    parser.add_argument("-p", "--per-name", metavar="FILE",
+                        help="CSV file to write the counts of every name "
+                        "to.")
+    parser.add_argument("-m", "--min-count", type=int, default=1,
+                        help="Only write names that leaked at least this "
+                        "often in a window (default: %(default)d).")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="Number of pcap files to read in parallel "
+                        "(default: %(default)d).")
+
+    args = parser.parse_args(argv)
+    args.window = args.window or ["hour"]
+    for window in args.window:
+        if args.slide and RESOLUTIONS[args.slide] > RESOLUTIONS[window]:
+            parser.error("--slide must not be longer than the window")
+    if args.lateness < 0:
+        parser.error("--lateness must not be negative")
+
+    return args
+
+
+def main(argv):
+
+    args = parse_args(argv)
+
+    series = []
+    for window in args.window:
+        label = "%s/%s" % (window, args.slide) \
+            if args.slide and args.slide != window else window
+        length = RESOLUTIONS[window]
+        slide = RESOLUTIONS[args.slide] if args.slide else length
+        series.append((label, LeakSeries(length, slide, args.lateness)))
+
+    totals = open(args.output, "w") if args.output else sys.stdout
+    per_name = open(args.per_name, "w") if args.per_name else None
+
+    def write(label, windows):
+
+        for start, total, counts in windows:
+            start = format_time(start)
+            totals.write("%s,%s,%d\n" % (label, start, total))
+            if per_name is None:
+                continue
+            for name, count in sorted(counts.items()):
+                if count >= args.min_count:
+                    per_name.write("%s,%s,%s,%d\n" % (label, start, name,
+                                                      count))
+
+    parse_seconds = TimeParser()
+    leaks = 0
+    records = read_records(args.files, args.jobs)
+    while True:
+        try:
+            time, name = next(records)
+        except StopIteration:
+            break
+        except ValueError as err:
+            log(err)
+            return 1
+        try:
+            seconds = parse_seconds(time)
+        except ValueError:
+            continue
+        leaks += 1
+        for label, leak_series in series:
+            leak_series.add(seconds, name)
+            write(label, leak_series.windows())
+
+    for label, leak_series in series:
+        write(label, leak_series.flush())
+
+    log("Counted %d leaks." % leaks)
+    late = max([leak_series.late for _, leak_series in series] or [0])
+    if late:
+        log("Dropped %d records that came after their window was written.  "
+            "Consider a larger --lateness." % late)
+
+    if totals is not sys.stdout:
+        totals.close()
+    if per_name is not None:
+        per_name.close()
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,275 @@
+"""
+Reading and counting leaked onion domains, in total and over time.
+
+Leak records are lines of the form "time,name", e.g.,
+"2017-09-18.20:06:54,xxlvbrloxvriy2c5.onion.", as printed by
+../code/analyse-pcap or extract_leaks.py, and may end in an annotation in
+square brackets, as in ../analysis_results/onion_leaks.txt.  Leaks can also be
+read straight from pcap files (see dns_pcap).
+"""
+
+import sys
+import heapq
+import calendar
+import datetime
+import collections
+
+from dns_pcap import TIME_FORMAT, is_pcap, read_pcaps
+
+# Window lengths, in seconds.
+
+RESOLUTIONS = collections.OrderedDict([("minute", 60),
+                                       ("hour", 60 * 60),
+                                       ("day", 24 * 60 * 60)])
+
+
+def parse_record(line):
+    """Return the (time, name) of the given leak record, or None if the line
+    is not a leak record.  The time is left as a string."""
+
+    fields = line.split(",", 1)
+    if len(fields) != 2 or not fields[1].split():
+        return None
+
+    return fields[0].strip(), fields[1].split()[0]
+
+
+def parse_time(time):
+    """Turn the time of a leak record into a datetime."""
+
+    return datetime.datetime.strptime(time, TIME_FORMAT)
+
+
+def format_time(seconds):
+    """Turn seconds since the epoch into the time format of leak records."""
+
+    return datetime.datetime.fromtimestamp(
+        seconds, datetime.timezone.utc).strftime(TIME_FORMAT)
+
+
+class TimeParser(object):
+    """
+    Turns the times of leak records into seconds since the epoch, treating
+    them as UTC.  Records come in time order, so we remember the last day
+    instead of parsing every time with strptime.
+    """
+
+    def __init__(self):
+
+        self.day = None
+        self.day_seconds = 0
+
+    def __call__(self, time):
+
+        day, clock = time[:10], time[11:]
+        if day != self.day:
+            self.day = day
+            self.day_seconds = calendar.timegm(parse_time(day + ".00:00:00")
+                                               .timetuple())
+
+        return self.day_seconds + int(clock[0:2]) * 3600 + \
+            int(clock[3:5]) * 60 + int(clock[6:8])
+
+
+def read_records(file_names, jobs=1):
+    """
+    Yield the (time, name) of all leak records in the given files, where
+    "-" is stdin.  Pcap files are read with dns_pcap, in parallel with
+    several jobs.
+    """
+
+    file_names = file_names or ["-"]
+    pcaps = [file_name != "-" and is_pcap(file_name)
+             for file_name in file_names]
+    queries = read_pcaps([file_name for file_name, pcap in
+                          zip(file_names, pcaps) if pcap], jobs)
+
+    for file_name, pcap in zip(file_names, pcaps):
+        if pcap:
+            yield from next(queries)
+            continue
+
+        fd = sys.stdin if file_name == "-" else open(file_name, "r")
+        try:
+            for line in fd:
+                record = parse_record(line)
+                if record is not None:
+                    yield record
+        finally:
+            if fd is not sys.stdin:
+                fd.close()
+
+
+class LeakCounter(object):
+    """
+    Counts how often every name leaked, using at most `capacity' counters.
+
+    Counts are exact as long as there are at most `capacity' distinct names.
+    Beyond that, we switch to the Space-Saving algorithm: a name without a
+    counter takes over the counter of the least frequent name, and inherits
+    its count as overestimation error.  Every count is then an upper bound
+    that exceeds the true count by at most the name's error, and every name
+    that leaked more than total/capacity times has a counter.
+    """
+
+    def __init__(self, capacity):
+
+        self.capacity = capacity
+        self.total = 0
+        self.counts = {}
+        self.errors = None
+        self.heap = None
+
+    @property
+    def exact(self):
+
+        return self.errors is None
+
+    def add(self, name, count=1):
+
+        self.total += count
+        if name in self.counts:
+            self.counts[name] += count
+        elif len(self.counts) < self.capacity:
+            self.counts[name] = count
+            if self.errors is not None:
+                self.errors[name] = 0
+                heapq.heappush(self.heap, (count, name))
+        else:
+            if self.errors is None:
+                self.start_sketch()
+            self.replace_min(name, count)
+
+    def start_sketch(self):
+        """Switch from exact counting to Space-Saving."""
+
+        self.errors = dict.fromkeys(self.counts, 0)
+        self.heap = [(count, name) for name, count in self.counts.items()]
+        heapq.heapify(self.heap)
+
+    def replace_min(self, name, count):
+        """Give the counter of the least frequent name to the given name."""
+
+        # The heap is only updated when we pop a stale entry, i.e., one whose
+        # name was counted since it was pushed.
+
+        while True:
+            min_count, min_name = heapq.heappop(self.heap)
+            if self.counts[min_name] == min_count:
+                break
+            heapq.heappush(self.heap, (self.counts[min_name], min_name))
+
+        del self.counts[min_name]
+        del self.errors[min_name]
+        self.counts[name] = min_count + count
+        self.errors[name] = min_count
+        heapq.heappush(self.heap, (min_count + count, name))
+
+    def max_error(self):
+        """Return the largest overestimation of any count."""
+
+        return max(self.errors.values()) if self.errors else 0
+
+    def items(self):
+        """Return (name, count, error) for all counted names, ordered by
+        ascending count, and by first appearance for equal counts."""
+
+        errors = self.errors or {}
+
+        return [(name, count, errors.get(name, 0)) for name, count in
+                sorted(self.counts.items(), key=lambda item: item[1])]
+
+    def top(self, n):
+        """Return (name, count, error) for the n most frequent names."""
+
+        return self.items()[-n:] if n else []
+
+
+class LeakSeries(object):
+    """
+    Counts leaks per name and in total, in windows of `length' seconds that
+    start every `slide' seconds.  Without `slide', windows do not overlap.
+
+    Leaks are counted in panes of `slide' seconds, and every window is the
+    sum of the last length/slide panes, which we keep up to date by adding
+    the newest pane and subtracting the oldest one.  Panes are closed once
+    we saw a leak `lateness' seconds after their end, so that only the open
+    panes and the panes of the current window are in memory.  Leaks of
+    panes that were already closed are counted in `late' and ignored.
+    """
+
+    def __init__(self, length, slide=None, lateness=0):
+
+        self.slide = slide or length
+        if length % self.slide:
+            raise ValueError("Window length %d is not a multiple of the slide "
+                             "%d." % (length, self.slide))
+        self.length = length
+        self.lateness = lateness
+        self.panes = {}
+        self.window = collections.deque()
+        self.counts = collections.Counter()
+        self.total = 0
+        self.next = None
+        self.last = None
+        self.watermark = None
+        self.late = 0
+
+    def add(self, seconds, name):
+        """Count a leak of the given name at the given time.  The windows
+        that it closes are returned by windows()."""
+
+        pane = seconds - seconds % self.slide
+        if self.next is not None and pane < self.next:
+            self.late += 1
+            return
+        if self.next is None:
+            self.next = pane
+
+        self.panes.setdefault(pane, collections.Counter())[name] += 1
+        if self.last is None or pane > self.last:
+            self.last = pane
+        if self.watermark is None or seconds - self.lateness > self.watermark:
+            self.watermark = seconds - self.lateness
+
+    def windows(self):
+        """
+        Yield the windows that were closed since the last call as (start,
+        total, counts).  `counts' maps names to their counts in the window,
+        and is only valid until the next window is yielded.
+        """
+
+        if self.watermark is not None:
+            yield from self.close(self.watermark)
+
+    def close(self, until):
+        """Close all panes that end at or before the given time, and yield
+        their windows."""
+
+        while self.next is not None and self.next + self.slide <= until:
+            pane = self.panes.pop(self.next, collections.Counter())
+            total = sum(pane.values())
+            self.window.append((pane, total))
+            self.counts.update(pane)
+            self.total += total
+
+            if len(self.window) > self.length // self.slide:
+                old, old_total = self.window.popleft()
+                self.total -= old_total
+                for name, count in old.items():
+                    self.counts[name] -= count
+                    if not self.counts[name]:
+                        del self.counts[name]
+
+            self.next += self.slide
+            yield self.next - self.length, self.total, self.counts
+
+    def flush(self):
+        """
+        Close all remaining panes and yield their windows, up to the last
+        window that holds the last pane, so that sliding windows at the end
+        are partial like the ones at the start.
+        """
+
+        if self.last is not None:
+            yield from self.close(self.last + self.length)
@@ -0,0 +1,358 @@
+#!/usr/bin/env python3
+#
+# For every leaked onion domain, find the known onion services it resembles,
+# e.g., to spot impersonation.  We compare the Levenshtein distance of the
+# (lower-case) onion labels, and support both v2 (16 characters) and v3 (56
+# characters) labels.  Known services are indexed so that a query does not
+# have to compare the leaked name against every reference:
+#
+# - For small radii, a segment index uses the pigeonhole principle: if two
+#   strings are within distance r, one of r+1 segments of one string appears
+#   unchanged in the other, shifted by at most r characters.
+# - For larger radii, a BK-tree prunes subtrees using the triangle inequality.
+#
+# The leaked names are read from the first column of a CSV file, e.g.,
+# onion_leak_frequency.csv.  The references are read from a file with one
+# onion domain per line and an optional "[annotation]", such as
+# ../analysis_results/onion_leaks.txt.  The output CSV holds one line per
+# match: "leaked,reference,distance,jaro_winkler,annotation".
+
+import re
+import sys
+import csv
+import heapq
+import argparse
+import collections
+import multiprocessing
+
+from similarity import levenshtein, jaro_winkler
+from apply_similarity import log, read_counts, format_similarity
+
+ANNOTATION = re.compile(r"\[(.*)\]\s*$")
+
+# Radii up to this use the segment index; larger ones use the BK-tree.
+
+MAX_SEGMENT_RADIUS = 4
+
+
+def onion_label(name):
+    """Return the lower-case onion label of the given domain name."""
+
+    labels = name.strip().lower().rstrip(".").split(".")
+    if len(labels) > 1 and labels[-1] == "onion":
+        return labels[-2]
+
+    return labels[-1]
+
+
+def read_references(file_name):
+    """
+    Return a mapping from the onion labels in the given file to their
+    annotations.  Lines may be prefixed by comma-separated fields such as a
+    time stamp, and end in an annotation in square brackets.
+    """
+
+    references = {}
+    with open(file_name, "r") as fd:
+        for line in fd:
+            annotation = ANNOTATION.search(line)
+            if annotation:
+                line = line[:annotation.start()]
+            fields = [f.strip() for f in line.split(",") if f.strip()]
+            if not fields:
+                continue
+            onions = [f for f in fields if ".onion" in f.lower()]
+            label = onion_label((onions or fields)[-1].split()[0])
+            references.setdefault(label, annotation.group(1)
+                                  if annotation else "")
+
+    return references
+
+
+class BKTree(object):
+    """
+    A Burkhard-Keller tree over strings under the Levenshtein distance.
+
+    Every node is a list [string, children], where children maps distances
+    to subtrees.  All strings in the subtree under distance d have distance
+    d to the node's string, so by the triangle inequality, a query within
+    radius r of the query string only needs to visit children whose distance
+    lies within r of the node's distance to the query string.
+    """
+
+    def __init__(self, strings=()):
+
+        self.root = None
+        self.size = 0
+        for s in strings:
+            self.add(s)
+
+    def __len__(self):
+
+        return self.size
+
+    def add(self, s):
+        """Add the given string to the tree."""
+
+        if self.root is None:
+            self.root = [s, {}]
+            self.size += 1
+            return
+
+        node = self.root
+        while True:
+            d = levenshtein(s, node[0])
+            if d == 0:
+                return
+            if d not in node[1]:
+                node[1][d] = [s, {}]
+                self.size += 1
+                return
+            node = node[1][d]
+
+    def search(self, s, radius):
+        """Return (distance, string) for all strings within the given radius
+        of `s', sorted by distance."""
+
+        found = []
+        stack = [self.root] if self.root is not None else []
+        while stack:
+            node = stack.pop()
+            d = levenshtein(s, node[0])
+            if d <= radius:
+                found.append((d, node[0]))
+            stack.extend(child for e, child in node[1].items()
+                         if d - radius <= e <= d + radius)
+
+        return sorted(found)
+
+    def nearest(self, s, k, radius=None):
+        """
+        Return (distance, string) for the k strings closest to `s' (and at
+        most `radius' away, if given), sorted by distance.
+        """
+
+        # `best' is a max-heap of the k closest strings so far, whose largest
+        # distance shrinks the search radius.  Nodes are visited closest
+        # first, which shrinks the radius quickly.
+
+        best = []
+        tau = float("inf") if radius is None else radius
+        queue = [(0, 0, self.root)] if self.root is not None else []
+        tie = 1
+        while queue:
+            lower, _, node = heapq.heappop(queue)
+            if lower > tau:
+                break
+            d = levenshtein(s, node[0])
+            if d <= tau:
+                heapq.heappush(best, (-d, node[0]))
+                if len(best) > k:
+                    heapq.heappop(best)
+                if len(best) == k:
+                    tau = min(tau, -best[0][0])
+            for e, child in node[1].items():
+                if abs(e - d) <= tau:
+                    heapq.heappush(queue, (max(lower, abs(e - d)), tie,
+                                           child))
+                    tie += 1
+
+        return sorted((-d, x) for d, x in best)
+
+
+def partition(length, parts):
+    """Split a string of the given length into the given number of
+    (start, size) segments of about equal size."""
+
+    bounds = [length * k // parts for k in range(parts + 1)]
+
+    return [(bounds[k], bounds[k + 1] - bounds[k]) for k in range(parts)]
+
+
+class SegmentIndex(object):
+    """
+    Finds all strings within a fixed Levenshtein radius r of a query.
+
+    Every string is split into r+1 segments, which are indexed by the
+    string's length, the segment's number, and its text.  r edits can
+    change at most r segments, so a match contains one of its segments
+    unchanged, at most r characters from where the segment starts.
+    """
+
+    def __init__(self, strings, radius):
+
+        self.radius = radius
+        self.index = collections.defaultdict(list)
+        for s in strings:
+            for k, (start, size) in enumerate(partition(len(s), radius + 1)):
+                self.index[(len(s), k, s[start:start + size])].append(s)
+
+    def candidates(self, s):
+        """Return the strings that share a segment with the given string."""
+
+        r = self.radius
+        found = set()
+        for length in range(max(0, len(s) - r), len(s) + r + 1):
+            for k, (start, size) in enumerate(partition(length, r + 1)):
+                for pos in range(max(0, start - r),
+                                 min(len(s) - size, start + r) + 1):
+                    found.update(self.index.get((length, k,
+                                                 s[pos:pos + size]), ()))
+
+        return found
+
+    def search(self, s):
+        """Return (distance, string) for all strings within the radius of
+        `s', sorted by distance."""
+
+        found = []
+        for x in self.candidates(s):
+            d = levenshtein(s, x)
+            if d <= self.radius:
+                found.append((d, x))
+
+        return sorted(found)
+
+
+class ReferenceIndex(object):
+    """Answers radius and top-k queries using segment indices for small radii
+    and a BK-tree for larger ones.  Both are built when first needed."""
+
+    def __init__(self, strings):
+
+        self.strings = list(strings)
+        self.segments = {}
+        self.tree = None
+
+    def search(self, s, radius):
+        """Return (distance, string) for all strings within the given radius
+        of `s', sorted by distance."""
+
+        if radius <= MAX_SEGMENT_RADIUS:
+            if radius not in self.segments:
+                self.segments[radius] = SegmentIndex(self.strings, radius)
+            return self.segments[radius].search(s)
+
+        if self.tree is None:
+            self.tree = BKTree(self.strings)
+
+        return self.tree.search(s, radius)
+
+    def nearest(self, s, k, radius=None):
+        """
+        Return (distance, string) for the k strings closest to `s' (and at
+        most `radius' away, if given), sorted by distance.
+        """
+
+        # Widen the radius until we found k strings.  Everything within the
+        # final radius was found, so the k closest ones are exact.
+
+        limit = MAX_SEGMENT_RADIUS if radius is None else \
+            min(radius, MAX_SEGMENT_RADIUS)
+        for r in range(limit + 1):
+            found = self.search(s, r)
+            if len(found) >= k:
+                return found[:k]
+        if radius is not None and radius <= MAX_SEGMENT_RADIUS:
+            return found
+
+        if self.tree is None:
+            self.tree = BKTree(self.strings)
+
+        return self.tree.nearest(s, k, radius)
+
+
+# Every worker process builds its own index once, in init_worker.
+
+_index = None
+_query = None
+
+
+def init_worker(references, top, radius):
+
+    global _index, _query
+    _index = ReferenceIndex(references)
+    _query = (top, radius)
+
+
+def query(name):
+    """Return the leaked name and its (distance, reference) matches."""
+
+    top, radius = _query
+    label = onion_label(name)
+    if top:
+        return name, _index.nearest(label, top, radius)
+
+    return name, _index.search(label, radius)
+
+
+def parse_args(argv):
+
+    parser = argparse.ArgumentParser(description="Find the known onion "
+                                     "services that leaked onion domains "
+                                     "resemble.")
+    parser.add_argument("leaks", help="CSV file with one leaked domain per "
+                        "line.")
+    parser.add_argument("references", help="File with one known onion "
+                        "domain per line.")
+    parser.add_argument("output", help="CSV file to write matches to.")
+    parser.add_argument("-k", "--top", type=int, default=1,
+                        help="Report the k closest references; 0 reports "
+                        "all references within --max-distance "
+                        "(default: %(default)d).")
+    parser.add_argument("-d", "--max-distance", type=int, default=4,
+                        help="Only report references within this "
+                        "Levenshtein distance; -1 means no limit "
+                        "(default: %(default)d).")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="Number of worker processes (default: 1).")
+
+    args = parser.parse_args(argv)
+    if args.max_distance < 0:
+        if not args.top:
+            parser.error("--top 0 requires --max-distance")
+        args.max_distance = None
+
+    return args
+
+
+def main(argv):
+
+    args = parse_args(argv)
+
+    names = list(read_counts(args.leaks))
+    references = read_references(args.references)
+    log("Querying %d leaked names against %d references." %
+        (len(names), len(references)))
+
+    worker_args = (list(references), args.top, args.max_distance)
+    if args.jobs > 1:
+        pool = multiprocessing.Pool(args.jobs, init_worker, worker_args)
+        results = pool.imap(query, names, chunksize=64)
+    else:
+        init_worker(*worker_args)
+        results = map(query, names)
+
+    matches = 0
+    with open(args.output, "w") as fd:
+        writer = csv.writer(fd, lineterminator="\n")
+        for name, found in results:
+            label = onion_label(name)
+            for d, reference in found:
+                writer.writerow([name, reference + ".onion", d,
+                                 format_similarity(jaro_winkler(label,
+                                                                reference)),
+                                 references[reference]])
+                matches += 1
+
+    if args.jobs > 1:
+        pool.close()
+        pool.join()
+
+    log("Wrote %d matches to '%s'." % (matches, args.output))
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
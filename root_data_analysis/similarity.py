@@ -0,0 +1,351 @@
+"""
+String similarity metrics and a candidate-pruning all-pairs engine.
+
+We support the Jaro, Jaro-Winkler, and Levenshtein similarity, the latter
+being one minus the edit distance divided by the length of the longer string.
+
+The metrics reproduce python-Levenshtein 0.12, which produced the CSV files in
+this directory.  Note that its Jaro-Winkler does not cap the common prefix at
+four characters, so two names that share a long prefix score very high.
+"""
+
+import bisect
+import collections
+
+METRICS = ["jaro", "jaro-winkler", "levenshtein"]
+DEFAULT_METRIC = "jaro-winkler"
+DEFAULT_THRESHOLD = 0.90
+DEFAULT_PREFIX_WEIGHT = 0.1
+
+# Pairs whose common prefix is at least this long are found by grouping names
+# on their first PREFIX_GROUP characters.  All other pairs have a small
+# Winkler bonus, which lets us demand a large character overlap from them.
+
+PREFIX_GROUP = 3
+
+
+def common_prefix(s1, s2):
+    """Return the length of the common prefix of the two strings."""
+
+    m = min(len(s1), len(s2))
+    p = 0
+    while p < m and s1[p] == s2[p]:
+        p += 1
+
+    return p
+
+
+def jaro(s1, s2):
+    """Return the Jaro similarity of the two strings."""
+
+    len1, len2 = len(s1), len(s2)
+    if not len1 or not len2:
+        return 1.0 if len1 == len2 else 0.0
+
+    # Make s1 always the shorter (or equally long) string.
+
+    if len1 > len2:
+        s1, s2, len1, len2 = s2, s1, len2, len1
+
+    # Assign every character of s2 to the earliest unassigned, equal character
+    # of s1 within the match window.  Assigned characters of s1 are replaced
+    # by None so that list.index() skips them.
+
+    halflen = (len1 + 1) // 2
+    unassigned = list(s1)
+    order = [0] * len1
+    match = 0
+    for i in range(min(len1 + halflen, len2)):
+        try:
+            j = unassigned.index(s2[i], max(0, i - halflen),
+                                 min(len1, i + halflen + 1))
+        except ValueError:
+            continue
+        match += 1
+        order[j] = match
+        unassigned[j] = None
+
+    if not match:
+        return 0.0
+
+    # Count transpositions, i.e., common characters that were assigned out of
+    # order.
+
+    rank = trans = 0
+    for o in order:
+        if o:
+            rank += 1
+            trans += o != rank
+
+    md = float(match)
+    return (md / len1 + md / len2 + 1.0 - trans / md / 2.0) / 3.0
+
+
+def winkler(jaro_value, prefix, prefix_weight=DEFAULT_PREFIX_WEIGHT):
+    """Apply the Winkler prefix bonus to the given Jaro similarity."""
+
+    j = jaro_value + (1.0 - jaro_value) * prefix * prefix_weight
+    return 1.0 if j > 1.0 else j
+
+
+def jaro_winkler(s1, s2, prefix_weight=DEFAULT_PREFIX_WEIGHT):
+    """Return the Jaro-Winkler similarity of the two strings."""
+
+    return winkler(jaro(s1, s2), common_prefix(s1, s2), prefix_weight)
+
+
+def levenshtein(s1, s2):
+    """
+    Return the Levenshtein (edit) distance of the two strings.
+
+    We use Hyyrö's bit-parallel variant of Myers' algorithm, which processes
+    a whole column of the dynamic programming matrix per character of the
+    longer string, using the shorter string's characters as bits.
+    """
+
+    if len(s1) < len(s2):
+        s1, s2 = s2, s1
+    if not s2:
+        return len(s1)
+
+    peq = {}
+    for i, c in enumerate(s2):
+        peq[c] = peq.get(c, 0) | (1 << i)
+
+    mask = (1 << len(s2)) - 1
+    last = 1 << (len(s2) - 1)
+    pv, mv, score = mask, 0, len(s2)
+    for c in s1:
+        eq = peq.get(c, 0)
+        xv = eq | mv
+        xh = (((eq & pv) + pv) ^ pv) | eq
+        ph = mv | (~(xh | pv) & mask)
+        mh = pv & xh
+        if ph & last:
+            score += 1
+        elif mh & last:
+            score -= 1
+        ph = ((ph << 1) | 1) & mask
+        mh = (mh << 1) & mask
+        pv = mh | (~(xv | ph) & mask)
+        mv = ph & xv
+
+    return score
+
+
+def levenshtein_similarity(s1, s2):
+    """Return the edit distance of the two strings as a similarity."""
+
+    longest = max(len(s1), len(s2))
+    if not longest:
+        return 1.0
+
+    return 1.0 - float(levenshtein(s1, s2)) / longest
+
+
+def jaro_bound(len1, len2, overlap):
+    """
+    Return an upper bound of the Jaro similarity of two non-empty strings.
+
+    `overlap' is an upper bound of the number of common characters, e.g., the
+    size of the intersection of both strings' character multisets.  The bound
+    assumes that there are no transpositions.
+    """
+
+    md = float(min(overlap, len1, len2))
+    if not md:
+        return 0.0
+
+    return (md / len1 + md / len2 + 1.0 - 0.0) / 3.0
+
+
+def jaro_winkler_bound(len1, len2, overlap, prefix,
+                       prefix_weight=DEFAULT_PREFIX_WEIGHT):
+    """Return an upper bound of the Jaro-Winkler similarity."""
+
+    return winkler(jaro_bound(len1, len2, overlap), prefix, prefix_weight)
+
+
+def levenshtein_bound(len1, len2, overlap):
+    """
+    Return an upper bound of the Levenshtein similarity of two non-empty
+    strings.  At most `overlap' characters can survive the edits.
+    """
+
+    longest = max(len1, len2)
+
+    return 1.0 - float(longest - min(overlap, len1, len2)) / longest
+
+
+def bounds(metrics, len1, len2, overlap, prefix,
+           prefix_weight=DEFAULT_PREFIX_WEIGHT):
+    """Return upper bounds of the given metrics of two non-empty strings."""
+
+    j = jaro_bound(len1, len2, overlap)
+    values = {"jaro": j,
+              "jaro-winkler": winkler(j, prefix, prefix_weight),
+              "levenshtein": levenshtein_bound(len1, len2, overlap)}
+
+    return [values[m] for m in metrics]
+
+
+def tokenize(name):
+    """
+    Turn the given name into a set of (character, occurrence) tokens.
+
+    The intersection of two token sets has the same size as the intersection
+    of the two character multisets.
+    """
+
+    seen = collections.Counter()
+    tokens = []
+    for c in name:
+        tokens.append((c, seen[c]))
+        seen[c] += 1
+
+    return tokens
+
+
+class AllPairs(object):
+    """
+    Finds all pairs of names whose similarity exceeds a threshold in at least
+    one of several metrics, without computing the similarity of every pair.
+
+    `thresholds' maps metrics to their thresholds, in the order in which
+    values are reported.  Every name is visited once per partner with a
+    larger index.  A pair is a candidate if both names share a prefix of at
+    least PREFIX_GROUP characters (which only matters for Jaro-Winkler), or
+    if their character multisets overlap enough to exceed a threshold with a
+    shorter prefix.  The overlap is the popcount of two token bitmasks, and
+    length buckets that cannot reach the required overlap are skipped
+    entirely.  Candidates must then pass the bound with their exact prefix
+    and overlap before we compute their exact similarities.  Jaro and
+    Jaro-Winkler share the character matching, which is done once per pair.
+
+    If `first' is given, we only consider pairs whose second name has at
+    least that index, e.g., to compare new names against old ones.
+    """
+
+    def __init__(self, names, thresholds=None,
+                 prefix_weight=DEFAULT_PREFIX_WEIGHT, first=0):
+
+        self.names = names
+        self.thresholds = thresholds or {DEFAULT_METRIC: DEFAULT_THRESHOLD}
+        self.metrics = list(self.thresholds)
+        self.prefix_weight = prefix_weight
+        self.first = first
+        self.needed = {}
+
+        # Represent every name's character multiset as a bitmask over all
+        # tokens.
+
+        bits = {}
+        self.masks = []
+        for n in names:
+            mask = 0
+            for token in tokenize(n):
+                mask |= 1 << bits.setdefault(token, len(bits))
+            self.masks.append(mask)
+
+        # Group names on their first PREFIX_GROUP characters, and bucket them
+        # by length.  Both are sorted by name index.
+
+        self.groups = collections.defaultdict(list)
+        self.buckets = collections.defaultdict(list)
+        for i, n in enumerate(names):
+            if len(n) >= PREFIX_GROUP and "jaro-winkler" in self.thresholds:
+                self.groups[n[:PREFIX_GROUP]].append(i)
+            self.buckets[len(n)].append(i)
+
+    def __len__(self):
+
+        return len(self.names)
+
+    def exceeds(self, values):
+        """Return True if any of the given values exceeds its threshold."""
+
+        return any(x > self.thresholds[m] for m, x in zip(self.metrics,
+                                                           values))
+
+    def min_overlap(self, len1, len2):
+        """
+        Return the overlap two names of the given lengths need to exceed a
+        threshold if their common prefix is shorter than PREFIX_GROUP.
+        """
+
+        key = (len1, len2)
+        if key not in self.needed:
+            m = 0
+            while m <= min(len1, len2) and not self.exceeds(
+                    bounds(self.metrics, len1, len2, m, PREFIX_GROUP - 1,
+                           self.prefix_weight)):
+                m += 1
+            self.needed[key] = m
+
+        return self.needed[key]
+
+    def candidates(self, i):
+        """Return the set of candidate partners j > i (and j >= first) of the
+        given name."""
+
+        found = set()
+        n1, mask = self.names[i], self.masks[i]
+        after = max(i, self.first - 1)
+
+        if n1[:PREFIX_GROUP] in self.groups:
+            group = self.groups[n1[:PREFIX_GROUP]]
+            found.update(group[bisect.bisect_right(group, after):])
+
+        for length, bucket in self.buckets.items():
+            need = self.min_overlap(len(n1), length)
+            if need > min(len(n1), length):
+                continue
+            masks = self.masks
+            start = bisect.bisect_right(bucket, after)
+            found.update([j for j in bucket[start:]
+                          if (mask & masks[j]).bit_count() >= need])
+
+        return found
+
+    def similarities(self, i, j):
+        """
+        Return the similarities of the given pair in all metrics, or None if
+        none of them exceeds its threshold.
+        """
+
+        n1, n2 = self.names[i], self.names[j]
+        if not self.exceeds(bounds(self.metrics, len(n1), len(n2),
+                                   (self.masks[i] & self.masks[j]).bit_count(),
+                                   common_prefix(n1, n2),
+                                   self.prefix_weight)):
+            return None
+
+        values = {}
+        if "jaro" in self.thresholds or "jaro-winkler" in self.thresholds:
+            values["jaro"] = jaro(n1, n2)
+            values["jaro-winkler"] = winkler(values["jaro"],
+                                             common_prefix(n1, n2),
+                                             self.prefix_weight)
+        if "levenshtein" in self.thresholds:
+            values["levenshtein"] = levenshtein_similarity(n1, n2)
+
+        values = [values[m] for m in self.metrics]
+
+        return values if self.exceeds(values) else None
+
+    def row(self, i):
+        """Yield (j, similarities) for all partners j > i that exceed a
+        threshold."""
+
+        for j in sorted(self.candidates(i)):
+            values = self.similarities(i, j)
+            if values is not None:
+                yield j, values
+
+    def matches(self, rows=None):
+        """Yield (i, j, similarities) for all pairs i < j that exceed a
+        threshold."""
+
+        for i in range(len(self.names)) if rows is None else rows:
+            for j, values in self.row(i):
+                yield i, j, values
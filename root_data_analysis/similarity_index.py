@@ -0,0 +1,63 @@
+"""
+A persistent index of the names that apply_similarity.py already compared.
+
+Together with the output file, which holds all pairs above the threshold, the
+index lets us fold in newly captured names without comparing all old names
+against each other again.  The index is a text file whose first line
+describes the metric and threshold, followed by one name per line.
+"""
+
+import os
+
+
+class SimilarityIndex(object):
+    """The names already processed for a given output file."""
+
+    def __init__(self, file_name, header):
+
+        self.file_name = file_name
+        self.header = header
+
+    def exists(self):
+
+        return os.path.exists(self.file_name)
+
+    def load(self):
+        """Return the indexed names, in the order they were added."""
+
+        with open(self.file_name, "r") as fd:
+            header = fd.readline().strip()
+            if header != self.header:
+                raise ValueError("Index '%s' was built with '%s', not '%s'." %
+                                 (self.file_name, header, self.header))
+            return [line.rstrip("\n") for line in fd]
+
+    def append(self, names):
+        """Add the given names to the index, creating it if necessary."""
+
+        exists = self.exists()
+        with open(self.file_name, "a") as fd:
+            if not exists:
+                fd.write(self.header + "\n")
+            for name in names:
+                fd.write(name + "\n")
+            fd.flush()
+            os.fsync(fd.fileno())
+
+    def truncate(self, count):
+        """Keep only the first `count' names, e.g., to undo an update."""
+
+        names = self.load()[:count]
+        temp_name = self.file_name + ".tmp"
+        with open(temp_name, "w") as fd:
+            fd.write(self.header + "\n")
+            for name in names:
+                fd.write(name + "\n")
+            fd.flush()
+            os.fsync(fd.fileno())
+        os.replace(temp_name, self.file_name)
+
+    def remove(self):
+
+        if self.exists():
+            os.remove(self.file_name)
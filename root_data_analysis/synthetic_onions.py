@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+#
+# Generate synthetic lists of leaked onion domains for benchmarks, in the
+# format of onion_leak_frequency.csv: "name,count" lines, e.g.,
+# "ni4hu4dadh5z2bur.onion.,1".
+#
+# Like the real list, the synthetic one holds case variants of some names, as
+# resolvers with DNS 0x20 randomise the case of queried names, and near-
+# duplicates that differ from an earlier name in a few characters, e.g.,
+# typos or phishing domains.  Counts follow a heavy-tailed distribution.
+
+import sys
+import random
+import string
+import argparse
+
+ALPHABET = string.ascii_lowercase + "234567"
+NAME_LENGTH = 16
+
+DEFAULT_VARIANTS = 0.05
+DEFAULT_NEAR = 0.05
+MAX_EDITS = 2
+
+
+def random_name(rng):
+
+    return "".join(rng.choice(ALPHABET) for _ in range(NAME_LENGTH))
+
+
+def case_variant(rng, name):
+    """Return the given name with the case of its letters randomised."""
+
+    return "".join(c.upper() if rng.random() < 0.5 else c for c in name)
+
+
+def near_duplicate(rng, name):
+    """Return the given name with up to MAX_EDITS characters substituted,
+    inserted, or deleted."""
+
+    chars = list(name)
+    for _ in range(rng.randint(1, MAX_EDITS)):
+        position = rng.randrange(len(chars))
+        edit = rng.random()
+        if edit < 0.6:
+            chars[position] = rng.choice(ALPHABET)
+        elif edit < 0.8:
+            chars.insert(position, rng.choice(ALPHABET))
+        elif len(chars) > 1:
+            del chars[position]
+
+    return "".join(chars)
+
+
+def onion_names(n, variants=DEFAULT_VARIANTS, near=DEFAULT_NEAR, seed=None):
+    """
+    Return a list of n distinct (name, count) tuples.  A fraction of
+    `variants' names are case variants, and a fraction of `near' names are
+    near-duplicates of earlier names.
+    """
+
+    rng = random.Random(seed)
+    labels = []
+    names = {}
+    while len(names) < n:
+        kind = rng.random()
+        if labels and kind < variants:
+            label = case_variant(rng, rng.choice(labels))
+        elif labels and kind < variants + near:
+            label = near_duplicate(rng, rng.choice(labels))
+        else:
+            label = random_name(rng)
+        name = label + ".onion."
+        if name in names:
+            continue
+        labels.append(label)
+        names[name] = int(rng.paretovariate(1.5))
+
+    return list(names.items())
+
+
+def parse_args(argv):
+
+    parser = argparse.ArgumentParser(description="Write a synthetic list of "
+                                     "leaked onion domains.")
+    parser.add_argument("output", help="CSV file to write.")
+    parser.add_argument("-n", "--names", type=int, default=1000,
+                        help="Number of distinct names (default: "
+                        "%(default)d).")
+    parser.add_argument("-c", "--variants", type=float,
+                        default=DEFAULT_VARIANTS,
+                        help="Fraction of names that are case variants "
+                        "(default: %(default).2f).")
+    parser.add_argument("-d", "--near", type=float, default=DEFAULT_NEAR,
+                        help="Fraction of names that are near-duplicates "
+                        "(default: %(default).2f).")
+    parser.add_argument("--seed", type=int,
+                        help="Seed for the random names.")
+
+    return parser.parse_args(argv)
+
+
+def main(argv):
+
+    args = parse_args(argv)
+
+    with open(args.output, "w") as fd:
+        for name, count in onion_names(args.names, args.variants, args.near,
+                                       args.seed):
+            fd.write("%s,%d\n" % (name, count))
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))